@@ -1,31 +1,230 @@
 #!/usr/bin/env python3
 
-import random
+import os
+import json
 import numpy as np
 import tensorflow as tf
-from collections import namedtuple, deque
+from collections import namedtuple
 
+from segment_tree import SumSegmentTree, MinSegmentTree
+from snapshot import collect_snapshot, write_snapshot, has_snapshot, read_header, read_column
 
-""" 
+
+# Prioritized replay parameters
+PER_ALPHA = 0.6
+PER_BETA = 0.4
+PER_EPS = 1e-6
+
+# ERE parameters
+ERE_ETA = 0.996
+ERE_CMIN = 5000
+
+
+"""
 Structure of a single Experience
-N.B: the exp. stored in the HER buffer should have as state (new state) 
+N.B: the exp. stored in the HER buffer should have as state (new state)
      the observation (new observation) concatenated with the goal
 """
 Experience = namedtuple("Experience", field_names = \
     ['state', 'action', 'reward', 'new_state', 'done'])
-    
+
+
+"""
+Structure of a whole episode of length t, as arrays:
+obs and achieved_goal have t+1 rows (the last new state is included),
+desired_goal, action, reward and done have t rows
+"""
+Episode = namedtuple("Episode", field_names = \
+    ['obs', 'achieved_goal', 'desired_goal', 'action', 'reward', 'done'])
+
+
+def episode_arrays(experiences):
+    """
+    Convert the experiences (with dict states) of an episode into an Episode
+    """
+    obs = [exp.state['observation'] for exp in experiences]
+    obs.append(experiences[-1].new_state['observation'])
+    achieved_goals = [exp.state['achieved_goal'] for exp in experiences]
+    achieved_goals.append(experiences[-1].new_state['achieved_goal'])
+    return Episode(np.array(obs),
+                   np.array(achieved_goals),
+                   np.array([exp.state['desired_goal'] for exp in experiences]),
+                   np.array([exp.action for exp in experiences]),
+                   np.array([exp.reward for exp in experiences]),
+                   np.array([exp.done for exp in experiences]))
+
+
+def relabel_episode(episode, reward_fn, strategy="future", future_k=4, rng=None):
+    """
+    Build all the hindsight experiences of an episode with array operations
+
+    Parameters
+    ----------
+    episode: Episode played in the env
+    reward_fn: reward function (achieved_goal, desired_goal, info),
+        vectorised over the first axis (e.g. env.compute_reward)
+    strategy: goal sampling strategy ('final' or 'future')
+    future_k: number of future goals per step ('future' only)
+    rng: numpy Generator used to draw the future steps
+
+    Return
+    ------
+    hindsight_exps: the real experiences followed by the relabelled ones, 
+        as an Experience of arrays in the HER canonical representation
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    T = len(episode.action)
+    achieved_goals = episode.achieved_goal[1:]
+
+    # hindsight steps and goals
+    if strategy == "final":
+        t = np.arange(T)
+        her_goals = np.repeat(achieved_goals[-1:], T, axis=0)
+    elif strategy == "future":
+        t = np.repeat(np.arange(T), future_k)
+        her_goals = achieved_goals[rng.integers(t, T)]
+    else:
+        raise TypeError("Wrong strategy for goal sampling." +
+                        " [available 'final', 'future']")
+    her_rewards = reward_fn(achieved_goals[t], her_goals, None)
+
+    t = np.concatenate([np.arange(T), t])
+    goals = np.concatenate([episode.desired_goal, her_goals])
+    return Experience(np.concatenate([episode.obs[t], goals], axis=1),
+                      episode.action[t],
+                      np.concatenate([episode.reward, her_rewards]),
+                      np.concatenate([episode.obs[t+1], goals], axis=1),
+                      episode.done[t])
+
+
+def ere_schedule(size, n_steps, horizon, eta=ERE_ETA, c_min=ERE_CMIN):
+    """
+    Sampling ranges of ERE (Emphasizing Recent Experience) for n_steps
+    consecutive updates: ck = max(size*eta^(k*horizon/n_steps), c_min)
+
+    Parameters
+    ----------
+    size: number of items in the buffer
+    n_steps: number of updates K
+    horizon: episode length (the paper uses 1000)
+    eta: recency factor (1: uniform sampling)
+    c_min: minimum sampling range
+
+    Return
+    ------
+    cks: array of n_steps sampling ranges
+    """
+    k = np.arange(n_steps)
+    return np.maximum(size * eta ** (k * horizon / n_steps), c_min)
+
 
 class HER_Buffer:
+    """
+    Ring buffer of hindsight experiences stored as a structure of arrays.
+    The columns are preallocated float32 arrays of length capacity (the
+    states in state_dtype, e.g. float16 or bfloat16 to halve their memory
+    and sampling traffic), allocated on the first store (when the state 
+    and action sizes are known).
+    With prioritized=True the items can also be sampled proportionally to 
+    their priority (see sample_prioritized)
+    """
 
-    def __init__(self, capacity):
-        self.buffer = deque(maxlen=capacity)
-        random.seed()
+    def __init__(self, capacity, prioritized=False, alpha=PER_ALPHA, beta=PER_BETA,
+                 eps=PER_EPS, state_dtype=np.float32):
+        """
+        Parameters
+        ----------
+        capacity: number of experiences that the buffer can hold
+        prioritized: True to keep the priorities of the items 
+        alpha: priority exponent (0: uniform sampling)
+        beta: importance-sampling exponent (1: full correction)
+        eps: constant added to the TD errors to get the priorities
+        state_dtype: storage dtype of the states and new states
+        """
+        self.capacity = capacity
+        self.state_dtype = np.dtype(state_dtype)
+        self.states = None
+        self.actions = None
+        self.rewards = None
+        self.new_states = None
+        self.dones = None
+        self.cursor = 0
+        self.size = 0
+        self.new_items = 0
+        self.unsaved_items = 0
+        self.snapshot_directory = None
+        self.rng = np.random.default_rng()
+        self.prioritized = prioritized
+        if prioritized:
+            self.alpha = alpha
+            self.beta = beta
+            self.eps = eps
+            self.max_priority = 1.0
+            self.sum_tree = SumSegmentTree(capacity)
+            self.min_tree = MinSegmentTree(capacity)
 
     def __len__(self):
-        return len(self.buffer)
+        return self.size
 
     def append(self, exp):
-        self.buffer.append(exp)
+        """
+        Write a single hindsight experience at the cursor position
+        """
+        if self.states is None:
+            self._allocate(len(exp.state), len(exp.action))
+        self.states[self.cursor] = exp.state
+        self.actions[self.cursor] = exp.action
+        self.rewards[self.cursor] = exp.reward
+        self.new_states[self.cursor] = exp.new_state
+        self.dones[self.cursor] = exp.done
+        if self.prioritized:
+            self._set_priorities(self.cursor, self.max_priority)
+        self.cursor = (self.cursor + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        self.new_items = min(self.new_items + 1, self.capacity)
+        self.unsaved_items = min(self.unsaved_items + 1, self.capacity)
+
+    def store_batch(self, batch):
+        """
+        Write a batch of hindsight experiences starting at the cursor
+
+        Parameters
+        ----------
+        batch: Experience of arrays in the HER canonical representation
+        """
+        n = len(batch.action)
+        if self.states is None:
+            self._allocate(batch.state.shape[1], batch.action.shape[1])
+        locations = (self.cursor + np.arange(n)) % self.capacity
+        self.states[locations] = batch.state
+        self.actions[locations] = batch.action
+        self.rewards[locations] = batch.reward
+        self.new_states[locations] = batch.new_state
+        self.dones[locations] = batch.done
+        if self.prioritized:
+            self._set_priorities(locations, self.max_priority)
+        self.cursor = (self.cursor + n) % self.capacity
+        self.size = min(self.size + n, self.capacity)
+        self.new_items = min(self.new_items + n, self.capacity)
+        self.unsaved_items = min(self.unsaved_items + n, self.capacity)
+
+    def consume_new_states(self):
+        """
+        Return the states||goals stored since the last call (e.g. for
+        the normalizer update) and mark them as consumed
+
+        Return
+        ------
+        list of (at most two, if the ring buffer wraps around) contiguous 
+        views of the states column
+        """
+        start = (self.cursor - self.new_items) % self.capacity
+        end = start + self.new_items
+        self.new_items = 0
+        if end <= self.capacity:
+            return [self.states[start:end]]
+        return [self.states[start:], self.states[:end - self.capacity]]
 
     def store_experience(self, experience, reward, goal):
         """
@@ -45,7 +244,7 @@ class HER_Buffer:
         """
         hindsight_exp = \
             self._hindsight_representation(experience, reward, goal)
-        self.buffer.append(hindsight_exp)
+        self.append(hindsight_exp)
         return hindsight_exp
 
     def sample(self, minibatch_size=1, ere_ck=None):
@@ -59,28 +258,185 @@ class HER_Buffer:
 
         Return
         -------
-        items: hindsight experiences sampled from the buffer
+        items: hindsight experiences sampled from the buffer, as a single
+            Experience whose fields are arrays with minibatch_size rows
         """
-        items = []
-        if ere_ck is None or ere_ck > len(self.buffer):
-            sample_range = len(self.buffer)
+        if ere_ck is None or ere_ck > self.size:
+            sample_range = self.size
         else:
             sample_range = int(ere_ck)
-        locations = random.sample(
-            range((len(self.buffer)-sample_range), len(self.buffer)), minibatch_size)
-        for index in locations:
-            items.append(self.buffer[index])
-        return items
+        # offsets back from the most recent item, without replacement
+        # unless more items than the sampling range are requested
+        offsets = self.rng.choice(sample_range, minibatch_size, 
+                                  replace=minibatch_size > sample_range)
+        locations = (self.cursor - 1 - offsets) % self.capacity
+        return self._gather(locations)
+
+    def ere_cks(self, n_steps, horizon, eta=ERE_ETA, c_min=ERE_CMIN):
+        """
+        ERE sampling ranges of n_steps updates on this buffer (see ere_schedule)
+        """
+        return ere_schedule(len(self), n_steps, horizon, eta, c_min)
+
+    def sample_ere(self, minibatch_size, ere_cks):
+        """
+        Sample one minibatch for each ERE range, in one vectorised draw:
+        the items of the k-th minibatch come from the ere_cks[k] most
+        recent ones (with replacement)
+
+        Return
+        ------
+        items: hindsight experiences, as a single Experience of arrays with
+            len(ere_cks)*minibatch_size rows, grouped by minibatch
+        """
+        ranges = np.minimum(np.asarray(ere_cks), self.size).astype(np.int64)
+        offsets = (self.rng.random((len(ranges), minibatch_size)) * 
+                   ranges[:, None]).astype(np.int64).ravel()
+        locations = (self.cursor - 1 - offsets) % self.capacity
+        return self._gather(locations)
+
+    def sample_prioritized(self, minibatch_size=1, beta=None, n_batches=1):
+        """
+        Sample items proportionally to their priority: the total priority
+        is split in minibatch_size equal segments and one item is drawn
+        from each of them, independently for each of n_batches minibatches
+
+        Parameters
+        ----------
+        minibatch_size: number of items to sample from the buffer, per minibatch
+        beta: importance-sampling exponent (default: self.beta)
+        n_batches: number of minibatches, each stratified over the whole
+            buffer (a single stratification of n_batches*minibatch_size 
+            items would give each minibatch one contiguous range of slots)
+
+        Return
+        ------
+        items: hindsight experiences, as an Experience of arrays with the
+            n_batches*minibatch_size items minibatch after minibatch
+        weights: importance-sampling weights of the items, normalized by
+            the maximum weight
+        indexes: locations of the items, for update_priorities
+        """
+        if not self.prioritized:
+            raise TypeError("The buffer was not created with prioritized=True")
+        if beta is None:
+            beta = self.beta
+        total = self.sum_tree.sum()
+        prefixsums = (np.arange(minibatch_size) + 
+                      self.rng.random((n_batches, minibatch_size))) * (total / minibatch_size)
+        prefixsums = prefixsums.ravel()
+        indexes = np.minimum(self.sum_tree.find_prefixsum_idx(prefixsums), self.size - 1)
+
+        # w_i = (N*P(i))^-beta / max_j w_j, with max_j w_j from the min priority
+        probabilities = self.sum_tree[indexes] / total
+        min_probability = self.min_tree.min() / total
+        weights = (probabilities / min_probability) ** (-beta)
+        return self._gather(indexes), weights.astype(np.float32), indexes
+
+    def update_priorities(self, indexes, td_errors):
+        """
+        Set the priorities (|td_error| + eps)^alpha of the sampled items
+        """
+        priorities = np.abs(np.asarray(td_errors, dtype=np.float64)).ravel() + self.eps
+        self.max_priority = max(self.max_priority, priorities.max())
+        self._set_priorities(indexes, priorities)
+
+    def _set_priorities(self, indexes, priorities):
+        priorities = np.asarray(priorities, dtype=np.float64) ** self.alpha
+        self.sum_tree[indexes] = priorities
+        self.min_tree[indexes] = priorities
+
+    def collect_snapshot(self, directory):
+        """
+        Copy the items stored since the last snapshot in directory (all 
+        of them for a new directory), to be written with 
+        snapshot.write_snapshot (e.g. in a background thread)
+        """
+        if directory == self.snapshot_directory and has_snapshot(directory):
+            n_items = self.unsaved_items
+        else:
+            n_items = self.size
+        self.unsaved_items = 0
+        self.snapshot_directory = directory
+        header = {'capacity': self.capacity, 'cursor': int(self.cursor), 
+                  'size': int(self.size)}
+        if self.prioritized:
+            header['max_priority'] = float(self.max_priority)
+        columns = None if self.states is None else self._snapshot_columns()
+        return collect_snapshot(directory, header, columns, self.cursor, n_items, 
+                                self.capacity)
+
+    def snapshot(self, directory):
+        """
+        Write an incremental snapshot of the buffer in directory
+        """
+        write_snapshot(self.collect_snapshot(directory))
+
+    def restore(self, directory, header=None):
+        """
+        Restore the items and counters of a snapshot (priorities are
+        reset to the max priority)
+
+        Parameters
+        ----------
+        directory: directory of the snapshot
+        header: counters to restore instead of the snapshot ones (the
+            header of an older collect_snapshot of the same directory)
+        """
+        if header is None:
+            header = read_header(directory)
+        if header['capacity'] != self.capacity:
+            raise ValueError("The snapshot in %s has capacity %d" % 
+                             (directory, header['capacity']))
+        if header['size'] > 0:
+            if self.states is None:
+                self._allocate(read_column(directory, 'states').shape[1],
+                               read_column(directory, 'actions').shape[1])
+            for name, column in self._snapshot_columns().items():
+                column[...] = read_column(directory, name, column.dtype)
+        self.cursor = header['cursor']
+        self.size = header['size']
+        self.new_items = 0
+        self.unsaved_items = 0
+        self.snapshot_directory = directory
+        if self.prioritized:
+            self.max_priority = header['max_priority']
+            if self.size > 0:
+                self._set_priorities(np.arange(self.size), self.max_priority)
+
+    def _snapshot_columns(self):
+        return {'states': self.states, 'actions': self.actions, 'rewards': self.rewards,
+                'new_states': self.new_states, 'dones': self.dones}
+
+    def _gather(self, locations):
+        """
+        Copy the items at locations out of the columns
+        """
+        return Experience(self.states[locations],
+                          self.actions[locations],
+                          self.rewards[locations],
+                          self.new_states[locations],
+                          self.dones[locations])
+
+    def _allocate(self, state_size, action_size):
+        """
+        Preallocate the columns of the buffer
+        """
+        self.states = np.zeros((self.capacity, state_size), self.state_dtype)
+        self.actions = np.zeros((self.capacity, action_size), np.float32)
+        self.rewards = np.zeros(self.capacity, np.float32)
+        self.new_states = np.zeros((self.capacity, state_size), self.state_dtype)
+        self.dones = np.zeros(self.capacity, np.float32)
 
     def _hindsight_representation(self, experience, reward, goal):
         """
         Convert the passed experience to the HER canonical representation
-        
+
         Parameters
         ----------
         experience: experience to convert
         goal: the goal obtained with any sampling strategy
-        
+
         Return
         ------
         experience converted
@@ -92,3 +448,434 @@ class HER_Buffer:
         state_goal = np.concatenate([state['observation'], goal])
         newState_goal = np.concatenate([newState['observation'], goal])
         return Experience(state_goal, action, reward, newState_goal, done)
+
+
+class HER_Memmap_Buffer(HER_Buffer):
+    """
+    Disk-backed HER_Buffer: the items are stored in a numpy.memmap file of
+    capacity packed records (state, action, reward, new_state, done), with
+    the states in state_dtype and the rest in float32, so that the buffer is limited
+    by the disk instead of the RAM and a random gather reads one page per 
+    item. The columns of HER_Buffer are strided views of the records.
+    The cursor and size are written with flush(): a buffer created on an 
+    existing directory is reopened with its items (priorities reset to 1)
+    """
+
+    def __init__(self, capacity, directory, **kwargs):
+        """
+        Parameters
+        ----------
+        capacity: number of experiences that the buffer can hold
+        directory: directory of the records and metadata files
+        kwargs: prioritized replay parameters and state_dtype (see HER_Buffer)
+        """
+        super(HER_Memmap_Buffer, self).__init__(capacity, **kwargs)
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.records = None
+        self.records_path = os.path.join(directory, "records.dat")
+        self.metadata_path = os.path.join(directory, "metadata.json")
+        if os.path.exists(self.metadata_path):
+            with open(self.metadata_path) as metadata_file:
+                metadata = json.load(metadata_file)
+            if metadata['capacity'] != capacity:
+                raise ValueError("The buffer in %s has capacity %d" % 
+                                 (directory, metadata['capacity']))
+            if np.dtype(metadata.get('state_dtype', 'float32')) != self.state_dtype:
+                raise ValueError("The buffer in %s stores %s states" % 
+                                 (directory, metadata['state_dtype']))
+            self._open(metadata['state_size'], metadata['action_size'], mode="r+")
+            self.cursor = metadata['cursor']
+            self.size = metadata['size']
+            if self.prioritized and self.size > 0:
+                self._set_priorities(np.arange(self.size), self.max_priority)
+
+    def flush(self):
+        """
+        Write the records and the metadata to disk
+        """
+        if self.records is None:
+            return
+        self.records.flush()
+        metadata = {'capacity': self.capacity,
+                    'state_size': self.states.shape[1],
+                    'action_size': self.actions.shape[1],
+                    'state_dtype': self.state_dtype.name,
+                    'cursor': int(self.cursor),
+                    'size': int(self.size)}
+        with open(self.metadata_path + ".tmp", "w") as metadata_file:
+            json.dump(metadata, metadata_file)
+        os.replace(self.metadata_path + ".tmp", self.metadata_path)
+
+    def _gather(self, locations):
+        """
+        Copy whole records out of the file, in file order, and split them
+        """
+        order = np.argsort(locations)
+        records = np.empty((len(locations), self.records.dtype.itemsize), np.uint8)
+        records[order] = self.record_bytes[locations[order]]
+        return self._columns(records.view(self.records.dtype)[:, 0])
+
+    def _allocate(self, state_size, action_size):
+        """
+        Create the records file
+        """
+        self._open(state_size, action_size, mode="w+")
+
+    def _open(self, state_size, action_size, mode):
+        """
+        Map the records file and view its columns
+        """
+        record_dtype = np.dtype([('state', self.state_dtype, (state_size,)),
+                                 ('action', np.float32, (action_size,)),
+                                 ('reward', np.float32),
+                                 ('new_state', self.state_dtype, (state_size,)),
+                                 ('done', np.float32)])
+        self.records = np.memmap(self.records_path, dtype=record_dtype, mode=mode,
+                                 shape=(self.capacity,))
+        # byte rows, gathered faster than the structured records
+        self.record_bytes = self.records.view(np.uint8).reshape(self.capacity, -1)
+        self.states, self.actions, self.rewards, self.new_states, self.dones = \
+            self._columns(self.records)
+
+    def _columns(self, records):
+        """
+        Views of the (state, action, reward, new_state, done) columns
+        """
+        return Experience(records['state'], records['action'], records['reward'],
+                          records['new_state'], records['done'])
+
+
+class VariableColumn:
+    """
+    Buffer column stored in a tf.Variable, indexed from the host like a
+    numpy array: reads return numpy arrays, writes are scatter updates
+    """
+
+    def __init__(self, shape, dtype=np.float32):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.variable = tf.Variable(tf.zeros(shape, tf.as_dtype(self.dtype)), trainable=False)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.variable[index].numpy()
+        return tf.gather(self.variable, np.asarray(index)).numpy()
+
+    def __setitem__(self, index, values):
+        if index is Ellipsis:
+            self.variable.assign(np.asarray(values, self.dtype))
+            return
+        indexes = np.asarray(index, np.int64).reshape(-1, 1)
+        values = np.asarray(values, self.dtype).reshape((len(indexes),) + self.shape[1:])
+        self.variable.scatter_nd_update(indexes, values)
+
+
+class HER_Tensor_Buffer(HER_Buffer):
+    """
+    HER_Buffer whose columns are tf.Variables (see VariableColumn), written
+    with one scatter update per column for each stored batch (episode). 
+    Minibatches can be sampled inside a compiled training step with 
+    sample_graph, without any host-side work per step
+    """
+
+    def __init__(self, capacity, state_dtype=np.float32):
+        super(HER_Tensor_Buffer, self).__init__(capacity, state_dtype=state_dtype)
+        self.graph_cursor = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self.graph_size = tf.Variable(0, dtype=tf.int64, trainable=False)
+
+    def append(self, exp):
+        super(HER_Tensor_Buffer, self).append(exp)
+        self._sync_counters()
+
+    def store_batch(self, batch):
+        super(HER_Tensor_Buffer, self).store_batch(batch)
+        self._sync_counters()
+
+    def restore(self, directory, header=None):
+        super(HER_Tensor_Buffer, self).restore(directory, header)
+        self._sync_counters()
+
+    def sample_graph(self, minibatch_size, ere_ck=None):
+        """
+        Sample items inside a graph, uniformly (with replacement) among the
+        ere_ck most recent ones (all of them if None)
+
+        Return
+        ------
+        items: hindsight experiences, as an Experience of float32 tensors
+        """
+        sample_range = self.graph_size
+        if ere_ck is not None:
+            sample_range = tf.minimum(tf.cast(ere_ck, tf.int64), sample_range)
+        offsets = tf.random.uniform([minibatch_size], 0, sample_range, dtype=tf.int64)
+        locations = tf.math.floormod(self.graph_cursor - 1 - offsets, self.capacity)
+        return Experience(*[tf.cast(tf.gather(column.variable, locations), tf.float32) 
+                            for column in (self.states, self.actions, self.rewards, 
+                                           self.new_states, self.dones)])
+
+    def _sync_counters(self):
+        """
+        Copy the cursor and size to the variables read by sample_graph
+        """
+        self.graph_cursor.assign(self.cursor)
+        self.graph_size.assign(self.size)
+
+    def _allocate(self, state_size, action_size):
+        """
+        Create the variables of the columns
+        """
+        self.states = VariableColumn((self.capacity, state_size), self.state_dtype)
+        self.actions = VariableColumn((self.capacity, action_size))
+        self.rewards = VariableColumn((self.capacity,))
+        self.new_states = VariableColumn((self.capacity, state_size), self.state_dtype)
+        self.dones = VariableColumn((self.capacity,))
+
+
+class HER_Episode_Buffer:
+    """
+    Episode-structured HER buffer: every episode is stored once and the
+    hindsight goals (and their rewards) are computed at sampling time.
+    Arrays have shape [episodes, T+1, dim] for observations and achieved
+    goals, and [episodes, T, dim] for desired goals, actions and dones
+    """
+
+    def __init__(self, capacity, max_timesteps, reward_fn, 
+                 strategy="future", replay_k=4, state_dtype=np.float32):
+        """
+        Parameters
+        ----------
+        capacity: number of transitions that the buffer can hold
+        max_timesteps: maximum length T of an episode
+        reward_fn: reward function (achieved_goal, desired_goal, info),
+            vectorised over the first axis (e.g. env.compute_reward)
+        strategy: goal sampling strategy ('final' or 'future')
+        replay_k: number of hindsight goals per real goal ('future' only)
+        state_dtype: storage dtype of the observations (the goals stay in 
+            float32: rounded goals could flip the sparse rewards near the 
+            distance threshold)
+        """
+        if strategy == "future":
+            self.relabel_p = 1 - (1. / (1 + replay_k))
+        elif strategy == "final":
+            self.relabel_p = 0.5
+        else:
+            raise TypeError("Wrong strategy for goal sampling." +
+                            " [available 'final', 'future']")
+        self.strategy = strategy
+        self.state_dtype = np.dtype(state_dtype)
+        self.max_timesteps = max_timesteps
+        self.max_episodes = capacity // max_timesteps
+        self.reward_fn = reward_fn
+        self.obs = None
+        self.achieved_goals = None
+        self.desired_goals = None
+        self.actions = None
+        self.dones = None
+        self.lengths = np.zeros(self.max_episodes, np.int64)
+        self.cursor = 0
+        self.n_episodes = 0
+        self.n_transitions = 0
+        self.new_episodes = 0
+        self.unsaved_episodes = 0
+        self.snapshot_directory = None
+        self.rng = np.random.default_rng()
+
+    def __len__(self):
+        return self.n_transitions
+
+    def store_episode(self, episode):
+        """
+        Store a whole episode in the buffer
+
+        Parameters
+        ----------
+        episode: Episode played in the env (see episode_arrays)
+
+        Return
+        -------
+        hindsight_exps: the transitions of the episode relabelled 
+            as they would be sampled, as an Experience of arrays
+        """
+        length = len(episode.action)
+        if self.obs is None:
+            self._allocate(episode.obs.shape[1], episode.desired_goal.shape[1], 
+                           episode.action.shape[1])
+        index = self.cursor
+        self.n_transitions += length - self.lengths[index]
+        self.obs[index, :length+1] = episode.obs
+        self.achieved_goals[index, :length+1] = episode.achieved_goal
+        self.desired_goals[index, :length] = episode.desired_goal
+        self.actions[index, :length] = episode.action
+        self.dones[index, :length] = episode.done
+        self.lengths[index] = length
+        self.cursor = (self.cursor + 1) % self.max_episodes
+        self.n_episodes = min(self.n_episodes + 1, self.max_episodes)
+        self.new_episodes = min(self.new_episodes + 1, self.max_episodes)
+        self.unsaved_episodes = min(self.unsaved_episodes + 1, self.max_episodes)
+        return self._relabel(np.full(length, index), np.arange(length))
+
+    def consume_new_states(self):
+        """
+        Return the states||goals of the episodes stored since the last call
+        (e.g. for the normalizer update), relabelled as they would be 
+        sampled, and mark them as consumed
+
+        Return
+        ------
+        list with the [transitions, state_size] array of states||goals
+        """
+        episodes = (self.cursor - 1 - np.arange(self.new_episodes)) % self.max_episodes
+        self.new_episodes = 0
+        lengths = self.lengths[episodes]
+        # (episode, t) of every stored transition, without Python loops
+        t = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        return [self._relabel(np.repeat(episodes, lengths), t).state]
+
+    def sample(self, minibatch_size=1, ere_ck=None):
+        """
+        Sample transitions and relabel their goals
+
+        Parameters
+        ----------
+        minibatch_size: number of transitions to sample
+        ere_ck: parameter ck of ERE algorithm which control sampling range,
+            mapped to the most recent ck/T episodes
+
+        Return
+        -------
+        items: hindsight experiences, as an Experience of arrays
+        """
+        if ere_ck is None:
+            sample_range = self.n_episodes
+        else:
+            sample_range = int(np.ceil(ere_ck / self.max_timesteps))
+            sample_range = min(max(sample_range, 1), self.n_episodes)
+        offsets = self.rng.integers(sample_range, size=minibatch_size)
+        episodes = (self.cursor - 1 - offsets) % self.max_episodes
+        t = (self.rng.random(minibatch_size) * 
+             self.lengths[episodes]).astype(np.int64)
+        return self._relabel(episodes, t)
+
+    def ere_cks(self, n_steps, horizon, eta=ERE_ETA, c_min=ERE_CMIN):
+        """
+        ERE sampling ranges of n_steps updates on this buffer (see ere_schedule)
+        """
+        return ere_schedule(len(self), n_steps, horizon, eta, c_min)
+
+    def sample_ere(self, minibatch_size, ere_cks):
+        """
+        Sample one minibatch for each ERE range, in one vectorised draw:
+        the k-th minibatch comes from the most recent ere_cks[k]/T episodes
+
+        Return
+        ------
+        items: hindsight experiences, as a single Experience of arrays with
+            len(ere_cks)*minibatch_size rows, grouped by minibatch
+        """
+        ranges = np.ceil(np.asarray(ere_cks) / self.max_timesteps)
+        ranges = np.clip(ranges, 1, self.n_episodes).astype(np.int64)
+        offsets = (self.rng.random((len(ranges), minibatch_size)) * 
+                   ranges[:, None]).astype(np.int64).ravel()
+        episodes = (self.cursor - 1 - offsets) % self.max_episodes
+        t = (self.rng.random(len(offsets)) * 
+             self.lengths[episodes]).astype(np.int64)
+        return self._relabel(episodes, t)
+
+    def collect_snapshot(self, directory):
+        """
+        Copy the episodes stored since the last snapshot in directory (all 
+        of them for a new directory), to be written with 
+        snapshot.write_snapshot (e.g. in a background thread)
+        """
+        if directory == self.snapshot_directory and has_snapshot(directory):
+            n_episodes = self.unsaved_episodes
+        else:
+            n_episodes = self.n_episodes
+        self.unsaved_episodes = 0
+        self.snapshot_directory = directory
+        header = {'max_episodes': self.max_episodes, 'max_timesteps': self.max_timesteps,
+                  'cursor': int(self.cursor), 'n_episodes': int(self.n_episodes),
+                  'n_transitions': int(self.n_transitions)}
+        columns = None if self.obs is None else self._snapshot_columns()
+        return collect_snapshot(directory, header, columns, self.cursor, n_episodes, 
+                                self.max_episodes)
+
+    def snapshot(self, directory):
+        """
+        Write an incremental snapshot of the buffer in directory
+        """
+        write_snapshot(self.collect_snapshot(directory))
+
+    def restore(self, directory, header=None):
+        """
+        Restore the episodes and counters of a snapshot (header: counters
+        to restore instead of the snapshot ones, see HER_Buffer.restore)
+        """
+        if header is None:
+            header = read_header(directory)
+        if (header['max_episodes'], header['max_timesteps']) != \
+           (self.max_episodes, self.max_timesteps):
+            raise ValueError("The snapshot in %s has %d episodes of %d steps" % 
+                             (directory, header['max_episodes'], header['max_timesteps']))
+        if header['n_episodes'] > 0:
+            if self.obs is None:
+                self._allocate(read_column(directory, 'obs').shape[2],
+                               read_column(directory, 'desired_goals').shape[2],
+                               read_column(directory, 'actions').shape[2])
+            for name, column in self._snapshot_columns().items():
+                column[...] = read_column(directory, name, column.dtype)
+        self.cursor = header['cursor']
+        self.n_episodes = header['n_episodes']
+        self.n_transitions = header['n_transitions']
+        self.new_episodes = 0
+        self.unsaved_episodes = 0
+        self.snapshot_directory = directory
+
+    def _snapshot_columns(self):
+        return {'obs': self.obs, 'achieved_goals': self.achieved_goals, 
+                'desired_goals': self.desired_goals, 'actions': self.actions,
+                'dones': self.dones, 'lengths': self.lengths}
+
+    def _relabel(self, episodes, t):
+        """
+        Build the hindsight transitions (episodes[i], t[i]), replacing the 
+        goal with an achieved one with probability relabel_p
+
+        Return
+        ------
+        Experience of arrays in the HER canonical representation
+        """
+        lengths = self.lengths[episodes]
+        goals = self.desired_goals[episodes, t]
+        relabel = self.rng.random(len(t)) < self.relabel_p
+        if self.strategy == "future":
+            future_offset = (self.rng.random(len(t)) * (lengths - t)).astype(np.int64)
+            future_t = t + 1 + future_offset
+        else:
+            future_t = lengths
+        goals[relabel] = \
+            self.achieved_goals[episodes[relabel], future_t[relabel]]
+        next_achieved_goals = self.achieved_goals[episodes, t+1]
+        rewards = self.reward_fn(next_achieved_goals, goals, None)
+        states = np.concatenate([self.obs[episodes, t], goals], axis=1, dtype=np.float32)
+        new_states = np.concatenate([self.obs[episodes, t+1], goals], axis=1, 
+                                    dtype=np.float32)
+        return Experience(states, self.actions[episodes, t], 
+                          np.asarray(rewards, np.float32), new_states, 
+                          self.dones[episodes, t])
+
+    def _allocate(self, obs_size, goal_size, action_size):
+        """
+        Preallocate the episode arrays of the buffer
+        """
+        T = self.max_timesteps
+        E = self.max_episodes
+        self.obs = np.zeros((E, T+1, obs_size), self.state_dtype)
+        self.achieved_goals = np.zeros((E, T+1, goal_size), np.float32)
+        self.desired_goals = np.zeros((E, T, goal_size), np.float32)
+        self.actions = np.zeros((E, T, action_size), np.float32)
+        self.dones = np.zeros((E, T), np.float32)
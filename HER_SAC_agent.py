@@ -1,14 +1,19 @@
 #!/usr/bin/env python3
 
 import random
+import functools
 import numpy as np
 import tensorflow as tf
 from tensorflow.keras.optimizers import Adam
+from tensorflow.keras.mixed_precision import LossScaleOptimizer
 from tensorflow_addons.optimizers import RectifiedAdam
 
 from normalizer import Normalizer
-from HER import HER_Buffer, Experience
-from models import ActorNetwork, CriticNetwork, ValueNetwork
+from HER import HER_Tensor_Buffer, Experience
+from models import ActorNetwork, CriticNetwork, EnsembleCriticNetwork, ValueNetwork, \
+                   InputNormalization
+from prefetch import MinibatchPrefetcher
+from distribute import is_multi_worker, host_all_reduce
 
 
 # Learning parameters
@@ -19,15 +24,25 @@ GAMMA = 0.95
 TAU = 0.005
 NORM_CLIP_RANGE = 5
 CLIP_MAX = 200
+N_CRITICS = 2
+CRITIC_SUBSET = 2
+SINGLE_PASS = True
+PRECISION = "float32"
+
+# Rendering parameters
+RENDER_EVERY = 10
 
 
 class HER_SAC_Agent:
 
-    def __init__(self, env, her_buffer, temperature="auto", optimizer='Adam'):
+    def __init__(self, env, her_buffer, temperature="auto", optimizer='Adam',
+                 compiled=True, jit_compile=False, render="never", 
+                 render_every=RENDER_EVERY, recorder=None, in_graph_norm=False,
+                 n_critics=N_CRITICS, critic_subset=CRITIC_SUBSET, 
+                 single_pass=SINGLE_PASS, precision=PRECISION, strategy=None):
 
         # env
         self.env = env
-        self.render = True
         self.her_buffer = her_buffer
         self.starting_state = self.env.reset()
         self.max_timesteps = self.env.spec.max_episode_steps
@@ -37,58 +52,172 @@ class HER_SAC_Agent:
         self.state_size = self.obs_size + self.goal_size
         self.action_size = self.env.action_space.shape[0]
 
+        # tensor-resident buffer: sampled inside the training graph
+        self.tensor_resident = isinstance(her_buffer, HER_Tensor_Buffer)
+        if self.tensor_resident and not in_graph_norm:
+            raise ValueError("A tensor-resident buffer needs in_graph_norm=True")
+
+        # render policy
+        if render not in ("never", "eval", "every_n", "record"):
+            raise TypeError("Wrong render policy. \
+                            [available 'never', 'eval', 'every_n', 'record']")
+        if render == "record" and recorder is None:
+            raise ValueError("A FrameRecorder is needed to record episodes")
+        self.render = render
+        self.render_every = render_every
+        self.recorder = recorder
+        self.played_episodes = 0
+        self.eval_episodes = 0
+
         # input shapes
         self.normal_state_shape = (self.state_size,)
         self.critic_state_shape = ((self.state_size + self.action_size),)
 
-        # networks
-        self.actor = ActorNetwork(self.normal_state_shape, self.action_size)
-        self.critic_1 = CriticNetwork(self.critic_state_shape)
-        self.critic_2 = CriticNetwork(self.critic_state_shape)
-        self.value = ValueNetwork(self.normal_state_shape)
-        self.target_value = ValueNetwork(self.normal_state_shape)
-
-        # temperature parameters
-        if temperature == "auto":
-            self.log_temperature = tf.Variable(tf.math.log(1.0), dtype=tf.float32)
-            self.target_entropy = -tf.constant(self.action_size, dtype=tf.float32)
-        elif isinstance(temperature, float):
-            if 0 < temperature <= 1:
-                self.log_temperature = tf.math.log(temperature)
+        # data-parallel learner: the variables are mirrored on the replicas
+        # of the strategy, which share minibatches of MINIBATCH_SAMPLE_SIZE
+        # items per replica (the normalizers of several workers are kept
+        # identical by all-reducing their updates)
+        self.distributed = strategy is not None
+        if self.distributed and self.tensor_resident:
+            raise ValueError("A tensor-resident buffer does not support distributed training")
+        self.strategy = strategy if self.distributed else tf.distribute.get_strategy()
+        self.n_replicas = self.strategy.num_replicas_in_sync
+        self.local_replicas = 1
+        self.all_reduce = None
+        if self.distributed:
+            self.local_replicas = len(strategy.extended.worker_devices)
+            if is_multi_worker(strategy):
+                self.all_reduce = functools.partial(host_all_reduce, strategy)
+        self.minibatch_size = MINIBATCH_SAMPLE_SIZE * self.local_replicas
+
+        with self.strategy.scope():
+            # in-graph input normalization, shared by all the networks
+            self.in_graph_norm = in_graph_norm
+            self.input_norm = None
+            if in_graph_norm:
+                self.input_norm = InputNormalization(self.state_size, clip_range=NORM_CLIP_RANGE,
+                                                     clip_max=CLIP_MAX)
+
+            # mixed precision: hidden layers in float16/bfloat16, inputs, 
+            # outputs, log-probs, temperature and targets in float32
+            if precision not in ("float32", "mixed_float16", "mixed_bfloat16"):
+                raise TypeError("Wrong precision. \
+                                [available 'float32', 'mixed_float16', 'mixed_bfloat16']")
+            self.precision = precision
+            self.loss_scaling = precision == "mixed_float16"
+
+            # networks: twin critics (n_critics=2), faster as two networks, or
+            # n_critics critics in one ensemble, with the min over all of them
+            # or REDQ-style over a random subset of critic_subset of them
+            if not 1 <= critic_subset <= n_critics:
+                raise ValueError("critic_subset must be in range [1, n_critics]")
+            self.n_critics = n_critics
+            self.critic_subset = critic_subset
+            self.actor = ActorNetwork(self.normal_state_shape, self.action_size, self.input_norm,
+                                      dtype=precision)
+            if n_critics == 2:
+                self.critic_1 = CriticNetwork(self.critic_state_shape, self.input_norm, 
+                                              dtype=precision)
+                self.critic_2 = CriticNetwork(self.critic_state_shape, self.input_norm, 
+                                              dtype=precision)
+                self.critic_networks = [self.critic_1, self.critic_2]
             else:
-                raise ValueError("Temperature parameter must be in range ]0,1]")
-        else:
-            raise TypeError("Wrong temperature coefficient. \
-                            [available 'auto' or float in ]0,1] range]")
-
-        # normalizers
-        self.state_norm = Normalizer(size=self.obs_size, clip_range=NORM_CLIP_RANGE)
-        self.goal_norm = Normalizer(size=self.goal_size, clip_range=NORM_CLIP_RANGE)
-
-        # building value and target value
-        input_tensor = tf.keras.Input(shape=(self.normal_state_shape), dtype=tf.float32)
-        self.value(input_tensor)
-        self.target_value(input_tensor)
-        self.soft_update(tau = 1.0)
-
-        # optimizers
-        if optimizer == 'Adam':
-            self.actor_optimizer = Adam(LEARNING_RATE)
-            self.critic1_optimizer = Adam(LEARNING_RATE)
-            self.critic2_optimizer = Adam(LEARNING_RATE)
-            self.value_optimizer = Adam(LEARNING_RATE)
+                self.critics = EnsembleCriticNetwork(self.critic_state_shape, n_critics, 
+                                                     self.input_norm, dtype=precision)
+                self.critic_networks = [self.critics]
+            self.value = ValueNetwork(self.normal_state_shape, self.input_norm, dtype=precision)
+            self.target_value = ValueNetwork(self.normal_state_shape, self.input_norm, 
+                                             dtype=precision)
+
+            # temperature parameters
+            self.auto_temperature = temperature == "auto"
             if temperature == "auto":
-                self.temperature_optimizer = Adam(LR_TEMPERATURE)
-        elif optimizer == 'Rectified_Adam':
-            self.actor_optimizer = RectifiedAdam(LEARNING_RATE)
-            self.critic1_optimizer = RectifiedAdam(LEARNING_RATE)
-            self.critic2_optimizer = RectifiedAdam(LEARNING_RATE)
-            self.value_optimizer = RectifiedAdam(LEARNING_RATE)
-            if temperature == "auto":
-                self.temperature_optimizer = RectifiedAdam(LR_TEMPERATURE)
-        else:
-            raise TypeError("Wrong or not supported optimizer. \
-                            [availiable 'Adam' or 'Rectified_Adam']")
+                self.log_temperature = tf.Variable(tf.math.log(1.0), dtype=tf.float32)
+                self.target_entropy = -tf.constant(self.action_size, dtype=tf.float32)
+            elif isinstance(temperature, float):
+                if 0 < temperature <= 1:
+                    self.log_temperature = tf.math.log(temperature)
+                else:
+                    raise ValueError("Temperature parameter must be in range ]0,1]")
+            else:
+                raise TypeError("Wrong temperature coefficient. \
+                                [available 'auto' or float in ]0,1] range]")
+
+            # normalizers
+            self.state_norm = Normalizer(size=self.obs_size, clip_range=NORM_CLIP_RANGE)
+            self.goal_norm = Normalizer(size=self.goal_size, clip_range=NORM_CLIP_RANGE)
+            self.input_buffers = {}
+            self.prefetcher = None
+
+            # building value and target value
+            state_batch = tf.zeros((1, self.state_size), dtype=tf.float32)
+            self.value(state_batch)
+            self.target_value(state_batch)
+            self.soft_update(tau = 1.0)
+
+            # building actor and critics
+            action_batch, _ = self.actor(state_batch)
+            self._critic_values(state_batch, action_batch)
+
+            # optimizers
+            if optimizer == 'Adam':
+                self.actor_optimizer = Adam(LEARNING_RATE)
+                self.critic_optimizers = [Adam(LEARNING_RATE) for _ in self.critic_networks]
+                self.value_optimizer = Adam(LEARNING_RATE)
+                if temperature == "auto":
+                    self.temperature_optimizer = Adam(LR_TEMPERATURE)
+            elif optimizer == 'Rectified_Adam':
+                self.actor_optimizer = RectifiedAdam(LEARNING_RATE)
+                self.critic_optimizers = [RectifiedAdam(LEARNING_RATE) 
+                                          for _ in self.critic_networks]
+                self.value_optimizer = RectifiedAdam(LEARNING_RATE)
+                if temperature == "auto":
+                    self.temperature_optimizer = RectifiedAdam(LR_TEMPERATURE)
+            else:
+                raise TypeError("Wrong or not supported optimizer. \
+                                [availiable 'Adam' or 'Rectified_Adam']")
+            if self.loss_scaling:
+                # dynamic loss scaling against float16 gradient underflow
+                # (log_temperature and its loss stay in float32)
+                self.actor_optimizer = LossScaleOptimizer(self.actor_optimizer)
+                self.critic_optimizers = [LossScaleOptimizer(critic_optimizer) 
+                                          for critic_optimizer in self.critic_optimizers]
+                self.value_optimizer = LossScaleOptimizer(self.value_optimizer)
+            if n_critics == 2:
+                self.critic1_optimizer, self.critic2_optimizer = self.critic_optimizers
+            else:
+                self.critic_optimizer = self.critic_optimizers[0]
+
+        # training step (graph-compiled unless compiled=False): all the 
+        # losses from one actor pass (single_pass) or the sequential updates
+        self.single_pass = single_pass
+        self.update = self._distributed_update if self.distributed else self._sac_update
+        self.train_step = self.update
+        if compiled:
+            self.train_step = tf.function(self.update, jit_compile=jit_compile,
+                input_signature=[
+                    tf.TensorSpec(shape=(None, self.state_size), dtype=tf.float32),
+                    tf.TensorSpec(shape=(None, self.action_size), dtype=tf.float32),
+                    tf.TensorSpec(shape=(None,), dtype=tf.float32),
+                    tf.TensorSpec(shape=(None, self.state_size), dtype=tf.float32),
+                    tf.TensorSpec(shape=(None,), dtype=tf.float32),
+                    tf.TensorSpec(shape=(None,), dtype=tf.float32)])
+        self.train_block = self._sac_update_block
+        if compiled:
+            self.train_block = tf.function(self._sac_update_block, jit_compile=jit_compile,
+                input_signature=[
+                    tf.TensorSpec(shape=(None, None, self.state_size), dtype=tf.float32),
+                    tf.TensorSpec(shape=(None, None, self.action_size), dtype=tf.float32),
+                    tf.TensorSpec(shape=(None, None), dtype=tf.float32),
+                    tf.TensorSpec(shape=(None, None, self.state_size), dtype=tf.float32),
+                    tf.TensorSpec(shape=(None, None), dtype=tf.float32),
+                    tf.TensorSpec(shape=(None, None), dtype=tf.float32)])
+        self.train_resident = self._sac_update_resident
+        if compiled:
+            self.train_resident = tf.function(self._sac_update_resident, jit_compile=jit_compile,
+                input_signature=[
+                    tf.TensorSpec(shape=(), dtype=tf.int32),
+                    tf.TensorSpec(shape=(None,), dtype=tf.float32)])
 
     def getBuffer(self):
         """
@@ -104,7 +233,8 @@ class HER_SAC_Agent:
         temperature = temperature_t.numpy()
         return temperature
 
-    def play_episode(self, criterion="random", epsilon=0):                          
+    def play_episode(self, criterion="random", epsilon=0, evaluation=False, 
+                     deterministic=False):                          
         """
         Play an episode choosing actions according to the selected criterion
         
@@ -112,31 +242,34 @@ class HER_SAC_Agent:
         ----------
         criterion: strategy to choose actions ('random' or 'SAC')
         epsilon: random factor for epsilon-greedy exploration strategy
+        evaluation: True for evaluation episodes (see the render policy)
+        deterministic: True to take the mean action of the policy ('SAC')
 
         Returns
         -------
         experiences: all experiences taken by the agent in the episode
         """
+        render, record = self._render_policy(evaluation)
+        frames = []
         state = self.env.reset()
         experiences = []
         done = False
         t = 0
         while t < self.max_timesteps and not done:
             t += 1
-            if self.render:
+            if render:
                 self.env.render()
+            if record:
+                frames.append(self.env.render(mode='rgb_array'))
             if criterion == "random":
                 action = self.env.action_space.sample()
             elif criterion == "SAC":
                 if np.random.random() < epsilon:
                     action = self.env.action_space.sample()
                 else:
-                    obs_norm = self.state_norm.normalize(state['observation'])
-                    goal_norm = self.goal_norm.normalize(state['desired_goal'])
-                    obs_goal = \
-                        np.concatenate([obs_norm, goal_norm])
-                    obs_goal = np.array(obs_goal, ndmin=2)
-                    action, _ = self.actor(obs_goal, noisy=False)
+                    obs_goal = self.actor_inputs(np.array(state['observation'], ndmin=2),
+                                                 np.array(state['desired_goal'], ndmin=2))
+                    action = self.actor.act(obs_goal, deterministic=deterministic)
                     action = action.numpy()[0]
             else:
                 raise TypeError("Wrong criterion for choosing the action. \
@@ -144,8 +277,76 @@ class HER_SAC_Agent:
             new_state, reward, done, info = self.env.step(action)
             experiences.append(Experience(state, action, reward, new_state, done))
             state = new_state
+        if record:
+            self.recorder.record(frames, "eval_episode_%d" % self.eval_episodes)
         return experiences
 
+    def _render_policy(self, evaluation):
+        """
+        Decide whether the next episode is rendered on screen and/or 
+        recorded, according to the render policy:
+        'never', 'eval' (evaluation episodes), 'every_n' (one episode every
+        render_every), 'record' (frames of one evaluation episode every 
+        render_every, written by the recorder)
+
+        Returns
+        -------
+        render, record flags
+        """
+        self.played_episodes += 1
+        if evaluation:
+            self.eval_episodes += 1
+        if self.render == "eval":
+            return evaluation, False
+        elif self.render == "every_n":
+            return self.played_episodes % self.render_every == 0, False
+        elif self.render == "record":
+            return False, evaluation and self.eval_episodes % self.render_every == 0
+        return False, False
+
+    def play_episodes(self, vec_env, criterion="random", epsilon=0):
+        """
+        Play an episode in each env of a vectorised env, in lockstep,
+        with one actor forward pass per timestep for all the envs
+        (headless: the render policy is not applied)
+
+        Parameters
+        ----------
+        vec_env: vectorised env (see vec_env.VecGoalEnv)
+        criterion: strategy to choose actions ('random' or 'SAC')
+        epsilon: random factor for epsilon-greedy exploration strategy
+
+        Returns
+        -------
+        episodes: for each env, all experiences taken by the agent
+        """
+        if criterion not in ("random", "SAC"):
+            raise TypeError("Wrong criterion for choosing the action. \
+                            [available 'random' or 'SAC']")
+        n_envs = vec_env.num_envs
+        states = vec_env.reset()
+        episodes = [[] for _ in range(n_envs)]
+        active = np.ones(n_envs, dtype=bool)
+        t = 0
+        while t < self.max_timesteps and active.any():
+            t += 1
+            actions = np.array([self.env.action_space.sample() for _ in range(n_envs)])
+            if criterion == "SAC":
+                greedy = np.random.random(n_envs) >= epsilon
+                if greedy.any():
+                    obs_goal = self.actor_inputs(states['observation'][greedy],
+                                                 states['desired_goal'][greedy])
+                    policy_actions = self.actor.act(obs_goal)
+                    actions[greedy] = policy_actions.numpy()
+            new_states, rewards, dones, infos = vec_env.step(actions, active)
+            for i in np.flatnonzero(active):
+                state = {key: value[i] for key, value in states.items()}
+                new_state = {key: value[i] for key, value in new_states.items()}
+                episodes[i].append(Experience(state, actions[i], rewards[i], new_state, dones[i]))
+            active &= ~dones
+            states = new_states
+        return episodes
+
     def optimization(self, minibatch=None, ere_ck=None):
         """
         Update networks in order to learn the correct policy
@@ -157,76 +358,416 @@ class HER_SAC_Agent:
 
         Returns
         -------
-        losses of all optimization processes
-        """
-        # 1° step: unzip minibatch sampled from HER
-        exp_actions, rewards, dones = [], [], []
-        if minibatch is None:
-            minibatch = self.her_buffer.sample(minibatch_size=MINIBATCH_SAMPLE_SIZE, 
-                                               ere_ck=ere_ck)
-        for exp in minibatch:
-            exp_actions.append(exp.action)
-            rewards.append(exp.reward)
-            dones.append(exp.done)
-        states, new_states = self.preprocess_inputs(minibatch)
-        del minibatch
+        losses of all optimization processes (one critic loss per critic)
+        """
+        # 1° step: unzip minibatch sampled from HER (prioritized buffers
+        # return importance-sampling weights and get the TD errors back),
+        # or take the next one ready in the prefetcher
+        indexes = None
+        if minibatch is None and self.tensor_resident:
+            losses = self.optimization_steps(1, None if ere_ck is None else [ere_ck])
+            return tuple(None if loss is None else loss[0] for loss in losses)
+        if minibatch is None and self.prefetcher is not None:
+            inputs, indexes = self.prefetcher.get()
+        else:
+            if minibatch is None:
+                minibatch, weights, indexes = self.sample_minibatch(ere_ck=ere_ck)
+            else:
+                weights = np.ones(len(minibatch.reward), np.float32)
+            inputs = self.train_inputs(minibatch, weights, reuse_buffers=True)
+
+        # 2°-5° steps: value, critics, actor and temperature updates
+        value_loss, critic_losses, actor_loss, temperature_loss, td_errors = \
+            self.train_step(*inputs)
+        if indexes is not None:
+            self._update_priorities(indexes, td_errors.numpy())
+        if self.prefetcher is not None and self.prefetcher.done():
+            self.prefetcher.close()
+            self.prefetcher = None
+        if not self.auto_temperature:
+            temperature_loss = None
+        return value_loss, critic_losses, actor_loss, temperature_loss
+
+    def optimization_steps(self, n_steps, ere_cks=None):
+        """
+        Run n_steps network updates inside a single graph call
+
+        Parameters
+        ----------
+        n_steps: number of optimization steps
+        ere_cks: parameters ck of ERE algorithm, one per step (None for
+            uniform sampling)
+
+        Returns
+        -------
+        losses of all optimization processes, stacked over the steps
+        """
+        # 1°-6° steps: with a tensor-resident buffer, sampling and updates
+        # in a single graph call
+        if self.tensor_resident:
+            if ere_cks is None:
+                ere_cks = np.full(n_steps, self.her_buffer.capacity)
+            value_loss, critic_losses, actor_loss, temperature_loss, _ = \
+                self.train_resident(tf.constant(n_steps, dtype=tf.int32),
+                                    tf.constant(ere_cks, dtype=tf.float32))
+            if not self.auto_temperature:
+                temperature_loss = None
+            return value_loss, critic_losses, actor_loss, temperature_loss
+
+        # 1° step: sample the n_steps minibatches as one block (with a
+        # prioritized buffer the priorities are updated after the block)
+        if ere_cks is None:
+            block, weights, indexes = self.sample_minibatch(n_batches=n_steps)
+        else:
+            if getattr(self.her_buffer, 'prioritized', False):
+                raise ValueError("ERE sampling is not supported with prioritized replay")
+            block = self.her_buffer.sample_ere(self.minibatch_size, ere_cks)
+            weights = np.ones(n_steps*self.minibatch_size, np.float32)
+            indexes = None
+        states, new_states = self.preprocess_inputs(block, reuse_buffers=True)
+
+        # 2°-6° steps: n_steps updates inside the graph
+        def stacked(array):
+            array = np.asarray(array, dtype=np.float32)
+            return tf.reshape(array, (n_steps, self.minibatch_size) + array.shape[1:])
+        value_loss, critic_losses, actor_loss, temperature_loss, td_errors = \
+            self.train_block(stacked(states), stacked(block.action), stacked(block.reward), 
+                             stacked(new_states), stacked(block.done), stacked(weights))
+        if indexes is not None:
+            self._update_priorities(indexes, td_errors.numpy())
+        if not self.auto_temperature:
+            temperature_loss = None
+        return value_loss, critic_losses, actor_loss, temperature_loss
+
+    def prefetch(self, n_steps, ere_cks=None):
+        """
+        Prepare the minibatches of the next n_steps optimization() calls
+        in a background thread, overlapping sampling and preprocessing 
+        with the gradient steps (the normalizer should not be updated
+        before they are consumed)
 
+        Parameters
+        ----------
+        n_steps: number of optimization steps
+        ere_cks: parameters ck of ERE algorithm, one per step (None for
+            uniform sampling)
+        """
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+        self.prefetcher = MinibatchPrefetcher(self, n_steps, ere_cks)
+
+    def _sac_update_block(self, states, exp_actions, rewards, new_states, dones, weights):
+        """
+        Consecutive SAC training steps in a tf.while_loop, one for each 
+        minibatch of the [steps, batch, ...] block (compiled into train_block)
+
+        Returns
+        -------
+        losses of all optimization processes and TD errors, stacked over 
+        the steps
+        """
+        return self._sac_update_loop(tf.shape(states)[0], lambda step: 
+            (states[step], exp_actions[step], rewards[step], new_states[step], 
+             dones[step], weights[step]))
+
+    def _sac_update_resident(self, n_steps, ere_cks):
+        """
+        Consecutive SAC training steps on minibatches sampled in graph from
+        the tensor-resident buffer, one for each ERE range in ere_cks
+        (compiled into train_resident)
+
+        Returns
+        -------
+        losses of all optimization processes and TD errors, stacked over 
+        the steps
+        """
+        weights = tf.ones([MINIBATCH_SAMPLE_SIZE])
+        return self._sac_update_loop(n_steps, lambda step: 
+            tuple(self.her_buffer.sample_graph(MINIBATCH_SAMPLE_SIZE, ere_cks[step])) + 
+            (weights,))
+
+    def _sac_update_loop(self, n_steps, minibatch_fn):
+        """
+        n_steps SAC training steps in a tf.while_loop, on the minibatches
+        returned by minibatch_fn(step)
+        """
+        # the first step is unrolled, so that optimizer slots are created
+        # outside the loop when tracing
+        first_losses = self.update(*minibatch_fn(0))
+        losses = [tf.TensorArray(tf.float32, size=n_steps).write(0, loss) 
+                  for loss in first_losses]
+
+        def body(step, losses):
+            step_losses = self.update(*minibatch_fn(step))
+            losses = [array.write(step, loss) for array, loss in zip(losses, step_losses)]
+            return step + 1, losses
+
+        _, losses = tf.while_loop(lambda step, _: step < n_steps, body, (1, losses))
+        return tuple(array.stack() for array in losses)
+
+    def _distributed_update(self, states, exp_actions, rewards, new_states, dones, weights):
+        """
+        One data-parallel SAC training step (compiled into train_step when 
+        a strategy is given): the minibatch of this worker is split across 
+        its replicas, which run _sac_update on their share while the 
+        optimizers all-reduce the gradients of actor, critics, value and 
+        temperature, then the target value is updated on all the replicas
+
+        Returns
+        -------
+        losses averaged over all the replicas and TD errors of the 
+        minibatch of this worker
+        """
+        inputs = (states, exp_actions, rewards, new_states, dones, weights)
+        shards = self.strategy.experimental_distribute_values_from_function(
+            lambda context: tuple(tf.split(tensor, self.local_replicas)[
+                context.replica_id_in_sync_group % self.local_replicas] for tensor in inputs))
+        value_loss, critic_losses, actor_loss, temperature_loss, td_errors = \
+            self.strategy.run(self._sac_update, args=shards)
+
+        # 6° step: soft update of the target value network, on all the replicas
+        self.soft_update()
+
+        losses = [self.strategy.reduce(tf.distribute.ReduceOp.MEAN, loss, axis=None) 
+                  for loss in (value_loss, critic_losses, actor_loss, temperature_loss)]
+        td_errors = tf.concat(self.strategy.experimental_local_results(td_errors), axis=0)
+        return tuple(losses) + (td_errors,)
+
+    def _sac_update(self, states, exp_actions, rewards, new_states, dones, weights):
+        """
+        One SAC training step on a preprocessed minibatch, followed by 
+        the target value soft update (compiled into train_step).
+        The actor is run once and the critics once on the experience 
+        actions and once on the policy actions: the sampled actions, their
+        log-probabilities and Q values are shared by all the losses, which
+        are computed before any update (the gradients of each network are
+        taken from its own loss, the other terms are constants)
+
+        Parameters
+        ----------
+        states: normalized state||goal tensor
+        exp_actions: actions taken in the experiences
+        rewards: rewards of the experiences
+        new_states: normalized new_state||goal tensor
+        dones: done flags of the experiences (as floats)
+        weights: importance-sampling weights of the critic losses
+            (ones for uniform sampling)
+
+        Returns
+        -------
+        losses of all optimization processes (one critic loss per critic)
+        and the TD errors of the experiences (mean over the critics)
+        """
+        if not self.single_pass:
+            return self._sac_update_sequential(states, exp_actions, rewards, 
+                                               new_states, dones, weights)
+
+        # 2°-5° steps: value, critics, actor and temperature losses
+        temperature = tf.exp(self.log_temperature)
+        v_tgt = self.target_value(new_states)
+        q_tgt = rewards + GAMMA*((1.0 - dones)*tf.reshape(v_tgt, [-1]))
+        q_tgt = tf.reshape(q_tgt, (-1, 1))
+        weights = tf.reshape(weights, (-1, 1))
+        with tf.GradientTape(persistent=True) as tape:
+            actions, log_probs = self.actor(states, noisy=True)
+            policy_q_values = self._critic_values(states, actions)
+            v = self.value(states)
+            v_target = tf.stop_gradient(self._target_q(policy_q_values) - temperature*log_probs)
+            value_loss = 0.5 * tf.reduce_mean(tf.square(v - v_target))
+            q_values = self._critic_values(states, exp_actions)
+            critic_losses = 0.5 * tf.reduce_mean(weights*tf.square(q_values - q_tgt), 
+                                                 axis=[1, 2])
+            critic_loss = tf.reduce_sum(critic_losses)
+            actor_loss = tf.reduce_mean(temperature*log_probs - 
+                                        self._policy_q(policy_q_values))
+            if self.auto_temperature:
+                temperature_loss = \
+                    tf.reduce_mean(-tf.exp(self.log_temperature)*
+                                   (tf.stop_gradient(log_probs) + self.target_entropy))
+            updates = [(self._scale_loss(optimizer, loss), network.trainable_variables, 
+                        optimizer) for loss, network, optimizer in (
+                           (value_loss, self.value, self.value_optimizer),
+                           *[(critic_loss, critic, optimizer) for critic, optimizer 
+                             in zip(self.critic_networks, self.critic_optimizers)],
+                           (actor_loss, self.actor, self.actor_optimizer))]
+            if self.auto_temperature:
+                updates.append((self._scale_loss(self.temperature_optimizer, temperature_loss),
+                                [self.log_temperature], self.temperature_optimizer))
+        td_errors = tf.reshape(tf.reduce_mean(tf.abs(q_values - q_tgt), axis=0), [-1])
+
+        # the same step updates all the networks
+        for loss, variables, optimizer in updates:
+            self._apply_gradients(optimizer, tape.gradient(loss, variables), variables)
+        if not self.auto_temperature:
+            temperature_loss = tf.constant(0.0)
+        del tape
+
+        # 6° step: soft update of the target value network (after the
+        # replica steps when distributed)
+        if not self.distributed:
+            self.soft_update()
+
+        return value_loss, critic_losses, actor_loss, temperature_loss, td_errors
+
+    def _sac_update_sequential(self, states, exp_actions, rewards, new_states, dones, weights):
+        """
+        SAC training step with sequential updates: value, critics, actor 
+        and temperature, each loss computed after the previous updates 
+        with a new actor pass (same inputs and outputs as _sac_update)
+        """
         # 2° step: optimize value network
         temperature = tf.exp(self.log_temperature)
         actions, log_probs = self.actor(states, noisy=True)
-        q1 = self.critic_1(states, actions)
-        q2 = self.critic_2(states, actions)
-        q = tf.minimum(q1, q2)
+        q = self._target_q(self._critic_values(states, actions))
         with tf.GradientTape() as value_tape:
             v = self.value(states)
             value_loss = 0.5 * tf.reduce_mean(tf.square(v - (q - temperature*log_probs)))
-        value_grads = value_tape.gradient(value_loss, self.value.trainable_variables)
-        self.value_optimizer.apply_gradients(
-            zip(value_grads, self.value.trainable_variables))
+            scaled_loss = self._scale_loss(self.value_optimizer, value_loss)
+        value_grads = value_tape.gradient(scaled_loss, self.value.trainable_variables)
+        self._apply_gradients(self.value_optimizer, value_grads, 
+                              self.value.trainable_variables)
 
         # 3° step: optimize critic networks
         v_tgt = self.target_value(new_states)
-        q_tgt = rewards + GAMMA*([not d for d in dones]*tf.reshape(v_tgt, -1))
-        q_tgt = tf.reshape(q_tgt, (len(rewards), 1))
-        with tf.GradientTape() as critic1_tape:
-            q1 = self.critic_1(states, exp_actions)
-            critic1_loss = 0.5 * tf.reduce_mean(tf.square(q1 - q_tgt))
-        with tf.GradientTape() as critic2_tape:
-            q2 = self.critic_2(states, exp_actions)
-            critic2_loss = 0.5 * tf.reduce_mean(tf.square(q2 - q_tgt))
-        critic1_grads = critic1_tape.gradient(critic1_loss, self.critic_1.trainable_variables)
-        critic2_grads = critic2_tape.gradient(critic2_loss, self.critic_2.trainable_variables)
-        self.critic1_optimizer.apply_gradients(
-            zip(critic1_grads, self.critic_1.trainable_variables))
-        self.critic2_optimizer.apply_gradients(
-            zip(critic2_grads, self.critic_2.trainable_variables))
+        q_tgt = rewards + GAMMA*((1.0 - dones)*tf.reshape(v_tgt, [-1]))
+        q_tgt = tf.reshape(q_tgt, (-1, 1))
+        weights = tf.reshape(weights, (-1, 1))
+        with tf.GradientTape(persistent=True) as critic_tape:
+            q_values = self._critic_values(states, exp_actions)
+            critic_losses = 0.5 * tf.reduce_mean(weights*tf.square(q_values - q_tgt), 
+                                                 axis=[1, 2])
+            # the critics are independent: one gradient for the sum
+            critic_loss = tf.reduce_sum(critic_losses)
+            scaled_losses = [self._scale_loss(optimizer, critic_loss) 
+                             for optimizer in self.critic_optimizers]
+        td_errors = tf.reshape(tf.reduce_mean(tf.abs(q_values - q_tgt), axis=0), [-1])
+        for critic, optimizer, scaled_loss in zip(self.critic_networks, self.critic_optimizers, 
+                                                  scaled_losses):
+            critic_grads = critic_tape.gradient(scaled_loss, critic.trainable_variables)
+            self._apply_gradients(optimizer, critic_grads, critic.trainable_variables)
+        del critic_tape
  
         # 4° step: optimize actor network
         with tf.GradientTape() as actor_tape:
             actions, log_probs = self.actor(states, noisy=True)
-            q1 = self.critic_1(states, actions)
-            q2 = self.critic_2(states, actions)
-            q = tf.minimum(q1, q2)
+            q = self._policy_q(self._critic_values(states, actions))
             actor_loss = tf.reduce_mean(temperature*log_probs - q)
-        actor_grads = actor_tape.gradient(actor_loss, self.actor.trainable_variables)
-        self.actor_optimizer.apply_gradients(
-            zip(actor_grads, self.actor.trainable_variables))
+            scaled_loss = self._scale_loss(self.actor_optimizer, actor_loss)
+        actor_grads = actor_tape.gradient(scaled_loss, self.actor.trainable_variables)
+        self._apply_gradients(self.actor_optimizer, actor_grads, 
+                              self.actor.trainable_variables)
 
         # 5° step: optimize temperature parameter
-        if isinstance(self.log_temperature, tf.Variable):
+        if self.auto_temperature:
             actions, log_probs = self.actor(states, noisy=False)
             with tf.GradientTape() as temperature_tape: 
                 temperature_loss = \
                     tf.reduce_mean(-tf.exp(self.log_temperature)*
                                   (log_probs + self.target_entropy))
+                scaled_loss = self._scale_loss(self.temperature_optimizer, temperature_loss)
             temperature_grads = \
-                temperature_tape.gradient(temperature_loss, [self.log_temperature])
-            self.temperature_optimizer.apply_gradients(
-                zip(temperature_grads, [self.log_temperature]))
+                temperature_tape.gradient(scaled_loss, [self.log_temperature])
+            self._apply_gradients(self.temperature_optimizer, temperature_grads, 
+                                  [self.log_temperature])
         else:
-            temperature_loss = None
+            temperature_loss = tf.constant(0.0)
 
-        return value_loss, critic1_loss, critic2_loss, actor_loss, temperature_loss
+        # 6° step: soft update of the target value network
+        if not self.distributed:
+            self.soft_update()
+
+        return value_loss, critic_losses, actor_loss, temperature_loss, td_errors
+
+    def _scale_loss(self, optimizer, loss):
+        """
+        Loss to differentiate, computed under the gradient tape: divided by
+        the number of replicas (their gradients are summed by the optimizers)
+        and scaled by the loss scale of the optimizer (mixed_float16 only)
+        """
+        if self.n_replicas > 1:
+            loss = loss / self.n_replicas
+        if isinstance(optimizer, LossScaleOptimizer):
+            return optimizer.get_scaled_loss(loss)
+        return loss
+
+    def _apply_gradients(self, optimizer, grads, variables):
+        """
+        Apply the gradients of a (scaled) loss
+        """
+        if isinstance(optimizer, LossScaleOptimizer):
+            grads = optimizer.get_unscaled_gradients(grads)
+        optimizer.apply_gradients(zip(grads, variables))
+
+    def _critic_values(self, states, actions):
+        """
+        Q values of all the critics, as a [n_critics, batch, 1] tensor
+        """
+        if self.n_critics == 2:
+            return tf.stack([self.critic_1(states, actions), self.critic_2(states, actions)])
+        return self.critics(states, actions)
+
+    def _target_q(self, q_values):
+        """
+        Min of the [n_critics, batch, 1] Q values over the ensemble, or 
+        over a random subset of critic_subset critics (REDQ)
+        """
+        if self.critic_subset < self.n_critics:
+            subset = tf.random.shuffle(tf.range(self.n_critics))[:self.critic_subset]
+            q_values = tf.gather(q_values, subset)
+        return tf.reduce_min(q_values, axis=0)
+
+    def _policy_q(self, q_values):
+        """
+        Q value of the actor loss: the min of twin critics, the ensemble
+        mean in REDQ mode
+        """
+        if self.critic_subset < self.n_critics:
+            return tf.reduce_mean(q_values, axis=0)
+        return tf.reduce_min(q_values, axis=0)
+
+    def sample_minibatch(self, minibatch_size=None, ere_ck=None, n_batches=1):
+        """
+        Sample a minibatch from the her buffer (default size: 
+        MINIBATCH_SAMPLE_SIZE per local replica), proportionally to the 
+        priorities if the buffer is prioritized, or n_batches minibatches 
+        concatenated (each one sampled over the whole buffer)
+
+        Returns
+        -------
+        minibatch, importance-sampling weights and buffer indexes 
+        (None for uniform sampling)
+        """
+        if minibatch_size is None:
+            minibatch_size = self.minibatch_size
+        if getattr(self.her_buffer, 'prioritized', False):
+            if ere_ck is not None:
+                raise ValueError("ERE sampling is not supported with prioritized replay")
+            return self.her_buffer.sample_prioritized(minibatch_size=minibatch_size, 
+                                                      n_batches=n_batches)
+        minibatch = self.her_buffer.sample(minibatch_size=n_batches*minibatch_size, 
+                                           ere_ck=ere_ck)
+        return minibatch, np.ones(n_batches*minibatch_size, np.float32), None
+
+    def train_inputs(self, minibatch, weights, reuse_buffers=False):
+        """
+        Preprocess a minibatch into the contiguous float32 tensors taken
+        by train_step (see preprocess_inputs for reuse_buffers)
+        """
+        states, new_states = self.preprocess_inputs(minibatch, reuse_buffers=reuse_buffers)
+        return tuple(tf.convert_to_tensor(np.ascontiguousarray(array, dtype=np.float32))
+                     for array in (states, minibatch.action, minibatch.reward, new_states,
+                                   minibatch.done, weights))
+
+    def _update_priorities(self, indexes, td_errors):
+        """
+        Feed the TD errors back to the prioritized buffer (under the lock 
+        of the prefetcher, which may be sampling)
+        """
+        if self.prefetcher is None:
+            self.her_buffer.update_priorities(indexes, td_errors)
+        else:
+            with self.prefetcher.lock:
+                self.her_buffer.update_priorities(indexes, td_errors)
 
     def soft_update(self, tau=TAU):
         """
@@ -236,7 +777,8 @@ class HER_SAC_Agent:
         ----------
         tau: weight for the value parameters to do the soft update
         """
-        for source, target in zip(self.value.variables, self.target_value.variables):
+        for source, target in zip(self.value.trainable_variables, 
+                                  self.target_value.trainable_variables):
             target.assign((1.0 - tau) * target + tau * source)
 
     def update_normalizer(self, batch, hindsight=False):
@@ -247,42 +789,144 @@ class HER_SAC_Agent:
         ----------
         batch: batch of experiences for the updating
         hindsight: True if the experiences are in the HER representation
+            (single experiences or Experience of arrays)
         """
         if not hindsight:
             obs = [exp.state['observation'] for exp in batch]
             g = [exp.state['desired_goal'] for exp in batch]
         else:
-            obs = [exp.state[0:-self.goal_size] for exp in batch]
-            g = [exp.state[-self.goal_size:] for exp in batch] 
-        self.state_norm.update(np.clip(obs, -CLIP_MAX, CLIP_MAX))
-        self.goal_norm.update(np.clip(g, -CLIP_MAX, CLIP_MAX))
+            states = np.concatenate([np.array(exp.state, ndmin=2) for exp in batch])
+            obs = states[:, 0:-self.goal_size]
+            g = states[:, -self.goal_size:]
+        self.state_norm.update(np.clip(obs, -CLIP_MAX, CLIP_MAX), self.all_reduce)
+        self.goal_norm.update(np.clip(g, -CLIP_MAX, CLIP_MAX), self.all_reduce)
+        if self.in_graph_norm:
+            self.input_norm.update(*self._input_affine())
+
+    def update_normalizer_from_buffer(self):
+        """
+        Update normalizer parameters with the states||goals stored in the 
+        her buffer since the last update (see consume_new_states)
+        """
+        chunks = self.her_buffer.consume_new_states()
+        if self.all_reduce is not None:
+            # the workers make the same all-reduces, even with no new states
+            chunks = [np.concatenate(chunks)]
+        for states in chunks:
+            if len(states) == 0 and self.all_reduce is None:
+                continue
+            states = np.clip(np.asarray(states, np.float32), -CLIP_MAX, CLIP_MAX)
+            self.state_norm.update(states[:, 0:-self.goal_size], self.all_reduce)
+            self.goal_norm.update(states[:, -self.goal_size:], self.all_reduce)
+        if self.in_graph_norm:
+            self.input_norm.update(*self._input_affine())
+
+    def normalizer_state(self):
+        """
+        Copy of the state and goal normalizer statistics, as a dict of 
+        arrays (e.g. for np.savez)
+        """
+        state = {}
+        for prefix, normalizer in (("state_", self.state_norm), ("goal_", self.goal_norm)):
+            state.update({prefix + key: value for key, value in normalizer.get_state().items()})
+        return state
+
+    def load_normalizer_state(self, state):
+        """
+        Restore the normalizer statistics returned by normalizer_state
+        """
+        for prefix, normalizer in (("state_", self.state_norm), ("goal_", self.goal_norm)):
+            normalizer.set_state({key[len(prefix):]: value for key, value in state.items()
+                                  if key.startswith(prefix)})
+        if self.in_graph_norm:
+            self.input_norm.update(*self._input_affine())
 
-    def preprocess_inputs(self, her_batch):
+    def snapshot_normalizers(self, path):
+        """
+        Save the normalizer statistics in a .npz file
+        """
+        np.savez(path, **self.normalizer_state())
+
+    def restore_normalizers(self, path):
+        """
+        Load the normalizer statistics saved by snapshot_normalizers
         """
-        Normalize states, goals and re-convert into HER representation
+        with np.load(path) as state:
+            self.load_normalizer_state(dict(state))
+
+    def actor_inputs(self, obs, goals):
+        """
+        Build the float32 state||goal input of the actor from [N, dim] 
+        observations and goals, normalized on the host unless the 
+        normalization is done in graph
+        """
+        if not self.in_graph_norm:
+            obs = self.state_norm.normalize(obs)
+            goals = self.goal_norm.normalize(goals)
+        return np.concatenate([obs, goals], axis=1).astype(np.float32)
+
+    def _input_affine(self):
+        """
+        Concatenated (offset, scale, clip_range) of the state and goal
+        normalizers, for the state||goal inputs
+        """
+        state_offset, state_scale = self.state_norm.affine()
+        goal_offset, goal_scale = self.goal_norm.affine()
+        offset = np.concatenate([state_offset, goal_offset])
+        scale = np.concatenate([state_scale, goal_scale])
+        clip_range = self.state_norm.clip_range
+        if self.goal_norm.clip_range != clip_range:
+            clip_range = np.concatenate([np.full(self.obs_size, clip_range, np.float32),
+                np.full(self.goal_size, self.goal_norm.clip_range, np.float32)])
+        return offset, scale, clip_range
+
+    def preprocess_inputs(self, her_batch, reuse_buffers=False):
+        """
+        Clip and normalize the state||goal and new_state||goal arrays in
+        one pass each, with the offset and scale vectors of the state and 
+        goal normalizers concatenated (passed through as float32 when the
+        normalization is done in graph)
         
         Parameters
         ----------
-        her_batch: batch of experiences expressed in the HER representation
+        her_batch: batch of experiences expressed in the HER representation,
+            as an Experience of arrays (see HER_Buffer.sample)
+        reuse_buffers: write into output buffers preallocated for this batch
+            size and reused across calls (the previous results are overwritten)
 
         Returns
         -------
-        input tensor for the networks
-        """
-        states, new_states, goals, new_goals = [], [], [], []
-        for i in range(len(her_batch)):
-            states.append(her_batch[i].state[0:-self.goal_size])
-            new_states.append(her_batch[i].new_state[0:-self.goal_size])
-            goals.append(her_batch[i].state[-self.goal_size:])
-            new_goals.append(her_batch[i].new_state[-self.goal_size:])
-        states = self.state_norm.normalize(np.clip(states, -CLIP_MAX, CLIP_MAX))
-        new_states = self.state_norm.normalize(np.clip(new_states, -CLIP_MAX, CLIP_MAX))
-        goals = self.goal_norm.normalize(np.clip(goals, -CLIP_MAX, CLIP_MAX))
-        new_goals = self.goal_norm.normalize(np.clip(new_goals, -CLIP_MAX, CLIP_MAX))
-        inputs = np.array(np.concatenate([states, goals], axis=1), ndmin=2)
-        new_inputs = np.array(np.concatenate([new_states, new_goals], axis=1), ndmin=2)
+        input arrays for the networks
+        """
+        if self.in_graph_norm:
+            # the networks clip and normalize their inputs
+            return (np.asarray(her_batch.state, dtype=np.float32), 
+                    np.asarray(her_batch.new_state, dtype=np.float32))
+        offset, scale, clip_range = self._input_affine()
+        if reuse_buffers:
+            shape = np.shape(her_batch.state)
+            if shape not in self.input_buffers:
+                self.input_buffers[shape] = (np.empty(shape, np.float32), 
+                                             np.empty(shape, np.float32))
+            outputs = self.input_buffers[shape]
+        else:
+            outputs = (None, None)
+        inputs, new_inputs = [self._clip_normalize(states, offset, scale, clip_range, out)
+                              for states, out in zip((her_batch.state, her_batch.new_state), 
+                                                     outputs)]
         return inputs, new_inputs
 
+    @staticmethod
+    def _clip_normalize(states, offset, scale, clip_range, out=None):
+        """
+        clip((clip(states, CLIP_MAX) - offset) / scale, clip_range), in place on out
+        """
+        out = np.clip(states, -CLIP_MAX, CLIP_MAX, out=out, dtype=np.float32, 
+                      casting='unsafe')
+        out -= offset
+        out /= scale
+        return np.clip(out, -clip_range, clip_range, out=out)
+
     def random_play(self, batch_size):
         """
         Play a batch_size number of episode with random policy
@@ -0,0 +1,679 @@
+#!/usr/bin/env python3
+
+"""
+Micro-benchmarks of the hot paths of the HER + SAC training loop.
+They do not need MuJoCo: the experiences are synthetic.
+
+Usage: python benchmarks.py [benchmark_name ...]
+"""
+
+# ___________________________________________________ Libraries ___________________________________________________ #
+
+
+import os
+import sys
+import time
+import random
+import numpy as np
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
+
+from HER import Experience, HER_Buffer, episode_arrays, relabel_episode
+from conftest import random_buffer
+
+# ___________________________________________________ Parameters ___________________________________________________ #
+
+
+OBS_SIZE = 25
+GOAL_SIZE = 3
+ACTION_SIZE = 4
+EPISODE_LEN = 50
+FUTURE_K = 4
+DISTANCE_THRESHOLD = 0.05
+REWARD_OFFSET = 1.0
+REPEATS = 200
+BUFFER_SIZE = 100000
+TRAIN_STEPS = 100
+HER_CAPACITY = 1000000
+
+# ___________________________________________________ Utilities ___________________________________________________ #
+
+
+def fetch_reward(achieved_goal, desired_goal, info):
+    """
+    Sparse reward of the Fetch envs with the DoneOnSuccessWrapper offset
+    """
+    distance = np.linalg.norm(achieved_goal - desired_goal, axis=-1)
+    return -(distance > DISTANCE_THRESHOLD).astype(np.float32) + REWARD_OFFSET
+
+
+def synthetic_episode(length=EPISODE_LEN):
+    """
+    Random episode with the dict observations of a GoalEnv
+    """
+    def observation():
+        return {'observation': np.random.randn(OBS_SIZE),
+                'achieved_goal': np.random.randn(GOAL_SIZE),
+                'desired_goal': goal}
+    goal = np.random.randn(GOAL_SIZE)
+    experiences = []
+    state = observation()
+    for _ in range(length):
+        new_state = observation()
+        experiences.append(Experience(state, np.random.randn(ACTION_SIZE),
+                                      0.0, new_state, False))
+        state = new_state
+    return experiences
+
+
+def make_agent(her_buffer, **kwargs):
+    """
+    HER_SAC_Agent on the MuJoCo-free PointGoalEnv
+    """
+    from goal_env import PointGoalEnv
+    from HER_SAC_agent import HER_SAC_Agent
+    agent = HER_SAC_Agent(PointGoalEnv(), her_buffer, **kwargs)
+    agent.update_normalizer([her_buffer.sample(minibatch_size=1000)], hindsight=True)
+    return agent
+
+
+def timeit(fn, repeats=REPEATS):
+    """
+    Mean wall-clock time of fn() in seconds
+    """
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats
+
+# ___________________________________________________ Benchmarks ___________________________________________________ #
+
+
+def bench_relabel():
+    """
+    Hindsight relabelling of one episode ('future' strategy):
+    one reward call per (step, future goal) pair vs one batched call
+    """
+    experiences = synthetic_episode()
+
+    def per_step():
+        goal = experiences[0].state['desired_goal']
+        for t in range(len(experiences)):
+            achieved_goal = experiences[t].new_state['achieved_goal']
+            np.concatenate([experiences[t].state['observation'], goal])
+            for _ in range(FUTURE_K):
+                future = random.randint(t, (len(experiences)-1))
+                desired_goal = experiences[future].new_state['achieved_goal']
+                fetch_reward(achieved_goal, desired_goal, None)
+                np.concatenate([experiences[t].state['observation'], desired_goal])
+                np.concatenate([experiences[t].new_state['observation'], desired_goal])
+
+    def batched():
+        relabel_episode(episode_arrays(experiences), fetch_reward, 
+                        strategy="future", future_k=FUTURE_K)
+
+    loop_time = timeit(per_step)
+    batch_time = timeit(batched)
+    print("relabel per step: %8.1f us/episode" % (loop_time * 1e6))
+    print("relabel batched:  %8.1f us/episode (x%.1f)" % (batch_time * 1e6, loop_time / batch_time))
+
+def bench_train_step():
+    """
+    Gradient steps/sec of HER_SAC_Agent.optimization, eager vs tf.function
+    """
+    her_buffer = random_buffer(BUFFER_SIZE)
+    results = {}
+    for name, kwargs in [("eager", {'compiled': False}),
+                         ("tf.function", {'compiled': True}),
+                         ("tf.function+XLA", {'compiled': True, 'jit_compile': True})]:
+        agent = make_agent(her_buffer, **kwargs)
+        results[name] = 1. / timeit(agent.optimization, repeats=TRAIN_STEPS)
+        print("%-16s %8.1f steps/s (x%.1f)" % (name, results[name], 
+                                               results[name] / results["eager"]))
+
+
+
+def bench_train_block():
+    """
+    Time per OPTIMIZATION_STEPS updates: Python loop of compiled steps
+    vs one call of the fused while_loop block
+    """
+    her_buffer = random_buffer(BUFFER_SIZE)
+    agent = make_agent(her_buffer)
+    n_steps = 50
+
+    def loop():
+        for _ in range(n_steps):
+            agent.optimization()
+
+    loop_time = timeit(loop, repeats=5)
+    block_time = timeit(lambda: agent.optimization_steps(n_steps), repeats=5)
+    print("python loop:  %8.1f ms/%d steps" % (loop_time * 1e3, n_steps))
+    print("fused block:  %8.1f ms/%d steps (x%.2f)" % (block_time * 1e3, n_steps, 
+                                                      loop_time / block_time))
+
+
+
+def bench_collection():
+    """
+    Env steps/sec of PointGoalEnv collection: sequential play_episode
+    vs lockstep play_episodes over N_ENVS in-process envs
+    """
+    from goal_env import PointGoalEnv
+    from vec_env import VecGoalEnv
+    agent = make_agent(random_buffer(10000))
+    n_envs = 8
+    vec_env = VecGoalEnv([PointGoalEnv] * n_envs)
+
+    def sequential():
+        for _ in range(n_envs):
+            agent.play_episode(criterion="SAC")
+
+    seq_time = timeit(sequential, repeats=3)
+    vec_time = timeit(lambda: agent.play_episodes(vec_env, criterion="SAC"), repeats=3)
+    steps = n_envs * EPISODE_LEN
+    print("sequential:  %8.1f steps/s" % (steps / seq_time))
+    print("vectorised:  %8.1f steps/s (x%.1f, %d envs)" % (steps / vec_time, 
+                                                           seq_time / vec_time, n_envs))
+
+
+
+def bench_policy_server():
+    """
+    Actions/sec and p99 latency of single-observation actor calls:
+    sequential forward passes vs concurrent clients of the PolicyServer
+    """
+    from goal_env import PointGoalEnv
+    from policy_server import PolicyServer
+    agent = make_agent(random_buffer(10000))
+    n_clients, n_requests = 32, 20
+    observation = PointGoalEnv().reset()
+
+    def sequential():
+        for _ in range(n_clients * n_requests):
+            obs_goal = np.concatenate([agent.state_norm.normalize(observation['observation']),
+                                       agent.goal_norm.normalize(observation['desired_goal'])])
+            agent.actor.act(np.array(obs_goal, ndmin=2, dtype=np.float32), deterministic=True)
+
+    server = PolicyServer(agent)
+
+    def concurrent():
+        with ThreadPoolExecutor(max_workers=n_clients) as executor:
+            list(executor.map(lambda _: [server.act(observation) for _ in range(n_requests)],
+                              range(n_clients)))
+
+    seq_time = timeit(sequential, repeats=2)
+    server_time = timeit(concurrent, repeats=2)
+    n_actions = n_clients * n_requests
+    print("sequential:    %8.1f actions/s" % (n_actions / seq_time))
+    print("policy server: %8.1f actions/s (x%.1f), p99 latency %.1f ms" % (
+        n_actions / server_time, seq_time / server_time, server.latency(99) * 1e3))
+    server.close()
+
+
+
+def bench_actor_inference():
+    """
+    Latency of a single-row actor forward pass: ActorNetwork.call 
+    (distributions + log-prob) vs the compiled ActorNetwork.act
+    """
+    agent = make_agent(random_buffer(10000))
+    state = np.random.randn(1, agent.state_size).astype(np.float32)
+    call_time = timeit(lambda: agent.actor(state, noisy=False)[0].numpy())
+    act_time = timeit(lambda: agent.actor.act(state).numpy())
+    mean_time = timeit(lambda: agent.actor.act(state, deterministic=True).numpy())
+    print("actor call:          %8.1f us" % (call_time * 1e6))
+    print("act (sampled):       %8.1f us (x%.1f)" % (act_time * 1e6, call_time / act_time))
+    print("act (deterministic): %8.1f us (x%.1f)" % (mean_time * 1e6, call_time / mean_time))
+
+
+
+def bench_preprocess():
+    """
+    us per 256-row minibatch of HER_SAC_Agent.preprocess_inputs: per-field
+    clip/normalize/concatenate vs the fused pass on reused buffers
+    """
+    from HER_SAC_agent import CLIP_MAX, MINIBATCH_SAMPLE_SIZE
+    her_buffer = random_buffer(10000)
+    agent = make_agent(her_buffer)
+    minibatch = her_buffer.sample(minibatch_size=MINIBATCH_SAMPLE_SIZE)
+    goal_size = agent.goal_size
+
+    def per_field():
+        states = agent.state_norm.normalize(np.clip(minibatch.state[:, :-goal_size], -CLIP_MAX, CLIP_MAX))
+        new_states = agent.state_norm.normalize(np.clip(minibatch.new_state[:, :-goal_size], -CLIP_MAX, CLIP_MAX))
+        goals = agent.goal_norm.normalize(np.clip(minibatch.state[:, -goal_size:], -CLIP_MAX, CLIP_MAX))
+        new_goals = agent.goal_norm.normalize(np.clip(minibatch.new_state[:, -goal_size:], -CLIP_MAX, CLIP_MAX))
+        return (np.concatenate([states, goals], axis=1), 
+                np.concatenate([new_states, new_goals], axis=1))
+
+    reference = per_field()
+    fused = agent.preprocess_inputs(minibatch, reuse_buffers=True)
+    error = max(np.abs(r - f).max() for r, f in zip(reference, fused))
+    field_time = timeit(per_field, repeats=2000)
+    fused_time = timeit(lambda: agent.preprocess_inputs(minibatch, reuse_buffers=True), 
+                        repeats=2000)
+    print("per field: %8.1f us/batch" % (field_time * 1e6))
+    print("fused:     %8.1f us/batch (x%.1f), max abs difference %.1e" % (
+        fused_time * 1e6, field_time / fused_time, error))
+
+
+
+def bench_normalizer_stats():
+    """
+    Accuracy of the Gaussian Normalizer statistics on 10^7 samples with a
+    large offset, updated in chunks and merged from 8 partial normalizers,
+    against numpy (float64, all samples at once)
+    """
+    from normalizer import Normalizer
+    n_samples, n_chunks, size = 10**7, 1000, 4
+    rng = np.random.default_rng(0)
+    samples = rng.normal(1000., 0.5, size=(n_samples, size)).astype(np.float32)
+    reference_mean = samples.mean(axis=0, dtype=np.float64)
+    reference_std = samples.std(axis=0, dtype=np.float64)
+
+    normalizer = Normalizer(size, eps=1e-6)
+    start = time.perf_counter()
+    for chunk in np.array_split(samples, n_chunks):
+        normalizer.update(chunk)
+    update_time = (time.perf_counter() - start) / n_chunks
+    partials = [Normalizer(size, eps=1e-6) for _ in range(8)]
+    for i, chunk in enumerate(np.array_split(samples, n_chunks)):
+        partials[i % len(partials)].update(chunk)
+    merged = partials[0]
+    for partial in partials[1:]:
+        merged.merge(partial)
+
+    # E[x^2] - E[x]^2 with float32 accumulators (previous implementation)
+    local_sum = np.zeros(size, np.float32)
+    local_sumsq = np.zeros(size, np.float32)
+    for chunk in np.array_split(samples, n_chunks):
+        local_sum += chunk.sum(axis=0)
+        local_sumsq += np.square(chunk).sum(axis=0)
+    naive_std = np.sqrt(np.maximum(0, local_sumsq / n_samples - np.square(local_sum / n_samples)))
+
+    print("update: %.1f us per %d-row chunk" % (update_time * 1e6, n_samples // n_chunks))
+    for name, mean, std in [("sum/sumsq float32", local_sum / n_samples, naive_std),
+                            ("welford/chan", normalizer.local_mean, normalizer.std),
+                            ("merged x8", merged.local_mean, merged.std)]:
+        print("%-18s max |mean err| %.2e  max |std rel err| %.2e" % (
+            name, np.abs(mean - reference_mean).max(), 
+            (np.abs(std - reference_std) / reference_std).max()))
+
+
+def bench_prioritized():
+    """
+    Throughput of a 1M HER_Buffer, uniform vs prioritized (sum/min trees):
+    episode stores, 256-row minibatch sampling and priority updates
+    """
+    from HER_SAC_agent import MINIBATCH_SAMPLE_SIZE
+    batch = relabel_episode(episode_arrays(synthetic_episode()), fetch_reward, 
+                            future_k=FUTURE_K)
+    td_errors = np.random.rand(MINIBATCH_SAMPLE_SIZE)
+    times = {}
+    for name, prioritized in [("uniform", False), ("prioritized", True)]:
+        her_buffer = random_buffer(HER_CAPACITY, prioritized=prioritized)
+        times[name] = (timeit(lambda: her_buffer.store_batch(batch)),
+                       timeit(lambda: her_buffer.sample(minibatch_size=MINIBATCH_SAMPLE_SIZE)))
+        print("%-12s store %8.1f us/episode, sample %8.1f us/batch" % (
+            name, times[name][0] * 1e6, times[name][1] * 1e6))
+    sample_time = timeit(lambda: her_buffer.sample_prioritized(MINIBATCH_SAMPLE_SIZE))
+    _, _, indexes = her_buffer.sample_prioritized(MINIBATCH_SAMPLE_SIZE)
+    update_time = timeit(lambda: her_buffer.update_priorities(indexes, td_errors))
+    print("prioritized  sample %8.1f us/batch (with IS weights), update %8.1f us/batch" % (
+        sample_time * 1e6, update_time * 1e6))
+    print("prioritized  %8.0f minibatches/s (sample + update)" % (
+        1. / (sample_time + update_time)))
+
+
+def bench_ere():
+    """
+    us per block of 50 minibatches from a 1M HER_Buffer: uniform block,
+    one ERE sample call per step vs the vectorised ERE block
+    """
+    from HER_SAC_agent import MINIBATCH_SAMPLE_SIZE
+    her_buffer = random_buffer(HER_CAPACITY)
+    n_steps = 50
+    ere_cks = her_buffer.ere_cks(n_steps, EPISODE_LEN, eta=0.922)
+    uniform_time = timeit(lambda: her_buffer.sample(n_steps*MINIBATCH_SAMPLE_SIZE), repeats=20)
+    loop_time = timeit(lambda: [her_buffer.sample(MINIBATCH_SAMPLE_SIZE, ere_ck=ck) 
+                                for ck in ere_cks], repeats=20)
+    ere_time = timeit(lambda: her_buffer.sample_ere(MINIBATCH_SAMPLE_SIZE, ere_cks), repeats=20)
+    print("ck from %d to %d" % (ere_cks[0], ere_cks[-1]))
+    print("uniform block:  %8.1f us/%d batches" % (uniform_time * 1e6, n_steps))
+    print("ERE per step:   %8.1f us/%d batches" % (loop_time * 1e6, n_steps))
+    print("ERE vectorised: %8.1f us/%d batches (x%.1f)" % (ere_time * 1e6, n_steps, 
+                                                          loop_time / ere_time))
+
+
+def bench_memmap():
+    """
+    256-row minibatch sampling from a 1M HER_Buffer in RAM vs the
+    disk-backed HER_Memmap_Buffer (warm page cache), and reopening time
+    """
+    import shutil
+    import tempfile
+    from HER import HER_Memmap_Buffer
+    from HER_SAC_agent import MINIBATCH_SAMPLE_SIZE
+    directory = tempfile.mkdtemp()
+    batch = relabel_episode(episode_arrays(synthetic_episode()), fetch_reward, 
+                            future_k=FUTURE_K)
+    try:
+        memmap_buffer = HER_Memmap_Buffer(HER_CAPACITY, directory)
+        while len(memmap_buffer) < HER_CAPACITY:
+            memmap_buffer.store_batch(batch)
+        memmap_buffer.flush()
+        her_buffer = random_buffer(HER_CAPACITY)
+        ram_time = timeit(lambda: her_buffer.sample(MINIBATCH_SAMPLE_SIZE), repeats=1000)
+        memmap_time = timeit(lambda: memmap_buffer.sample(MINIBATCH_SAMPLE_SIZE), repeats=1000)
+        start = time.perf_counter()
+        reopened = HER_Memmap_Buffer(HER_CAPACITY, directory)
+        reopen_time = time.perf_counter() - start
+        print("RAM:     %8.1f us/batch" % (ram_time * 1e6))
+        print("memmap:  %8.1f us/batch (x%.2f), file %.0f MB" % (
+            memmap_time * 1e6, memmap_time / ram_time, reopened.records.nbytes / 2**20))
+        print("reopen:  %8.1f ms for %d items" % (reopen_time * 1e3, len(reopened)))
+        del memmap_buffer, reopened
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_snapshot():
+    """
+    Binary snapshots of a full 1M HER_Buffer: full write, incremental 
+    write after one more episode and restore into a new buffer
+    """
+    import shutil
+    import tempfile
+    directory = tempfile.mkdtemp()
+    batch = relabel_episode(episode_arrays(synthetic_episode()), fetch_reward, 
+                            future_k=FUTURE_K)
+    try:
+        her_buffer = random_buffer(HER_CAPACITY)
+        start = time.perf_counter()
+        her_buffer.snapshot(directory)
+        full_time = time.perf_counter() - start
+        her_buffer.store_batch(batch)
+        start = time.perf_counter()
+        her_buffer.snapshot(directory)
+        incremental_time = time.perf_counter() - start
+        restored = HER_Buffer(HER_CAPACITY)
+        start = time.perf_counter()
+        restored.restore(directory)
+        restore_time = time.perf_counter() - start
+        size = sum(entry.stat().st_size for entry in os.scandir(directory))
+        print("full snapshot:        %8.1f ms, %.0f MB" % (full_time * 1e3, size / 2**20))
+        print("incremental snapshot: %8.1f ms (%d items)" % (incremental_time * 1e3, 
+                                                            len(batch.action)))
+        print("restore:              %8.1f ms (%.0f M items/s)" % (
+            restore_time * 1e3, len(restored) / restore_time / 1e6))
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_checkpoint():
+    """
+    Training-loop stall of a full checkpoint (networks, optimizers, 
+    normalizers, 1M buffer after one more episode): asynchronous save vs 
+    save + wait for the writes (median of 5 checkpoints)
+    """
+    import shutil
+    import tempfile
+    from checkpoint import TrainingCheckpointer
+    directory = tempfile.mkdtemp()
+    batch = relabel_episode(episode_arrays(synthetic_episode()), fetch_reward, 
+                            future_k=FUTURE_K)
+    try:
+        her_buffer = random_buffer(HER_CAPACITY)
+        agent = make_agent(her_buffer)
+        agent.optimization_steps(2)
+        checkpointer = TrainingCheckpointer(agent, directory)
+        checkpointer.save({'epoch': 0, 'cycle': 0})
+        checkpointer.wait()
+        stall_times, total_times = [], []
+        for cycle in range(1, 6):
+            her_buffer.store_batch(batch)
+            start = time.perf_counter()
+            checkpointer.save({'epoch': 0, 'cycle': cycle})
+            stall_times.append(time.perf_counter() - start)
+            checkpointer.wait()
+            total_times.append(time.perf_counter() - start)
+        checkpointer.close()
+        print("checkpoint stall (async): %8.1f ms" % (np.median(stall_times) * 1e3))
+        print("checkpoint save + wait:   %8.1f ms" % (np.median(total_times) * 1e3))
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_prefetch():
+    """
+    ms per optimization step with synchronous sampling/preprocessing vs 
+    minibatches prefetched in a background thread, on a 1M HER_Buffer 
+    and on a 1M HER_Episode_Buffer (relabelling at sample time)
+    """
+    from goal_env import PointGoalEnv
+    from HER import HER_Episode_Buffer
+    n_steps = 200
+    episode_buffer = HER_Episode_Buffer(HER_CAPACITY, EPISODE_LEN, PointGoalEnv().compute_reward)
+    episode = episode_arrays(synthetic_episode())
+    while episode_buffer.n_episodes < episode_buffer.max_episodes:
+        episode_buffer.store_episode(episode)
+    for name, her_buffer in [("transitions", random_buffer(HER_CAPACITY)),
+                             ("episodes", episode_buffer)]:
+        agent = make_agent(her_buffer)
+
+        def synchronous():
+            for _ in range(n_steps):
+                agent.optimization()
+
+        def prefetched():
+            agent.prefetch(n_steps)
+            for _ in range(n_steps):
+                agent.optimization()
+
+        sync_time = timeit(synchronous, repeats=3) / n_steps
+        prefetch_time = timeit(prefetched, repeats=3) / n_steps
+        print("%-12s synchronous %6.2f ms/step, prefetched %6.2f ms/step (%+.1f%%)" % (
+            name, sync_time * 1e3, prefetch_time * 1e3, 
+            100 * (prefetch_time / sync_time - 1)))
+
+
+def bench_resident():
+    """
+    ms per optimization step (in-graph normalization, 1M buffer): host 
+    sampling + numpy-to-tensor conversion vs the tensor-resident buffer
+    sampled inside the training graph, for single steps and 50-step blocks
+    """
+    from HER import HER_Tensor_Buffer
+    n_steps = 50
+    batch = relabel_episode(episode_arrays(synthetic_episode()), fetch_reward, 
+                            future_k=FUTURE_K)
+    tensor_buffer = HER_Tensor_Buffer(HER_CAPACITY)
+    while len(tensor_buffer) < HER_CAPACITY:
+        tensor_buffer.store_batch(batch)
+    store_time = timeit(lambda: tensor_buffer.store_batch(batch))
+    print("tensor buffer store: %8.1f us/episode" % (store_time * 1e6))
+    for name, her_buffer in [("host", random_buffer(HER_CAPACITY)), 
+                             ("resident", tensor_buffer)]:
+        agent = make_agent(her_buffer, in_graph_norm=True)
+        step_time = timeit(agent.optimization)
+        block_time = timeit(lambda: agent.optimization_steps(n_steps), repeats=10) / n_steps
+        print("%-9s single step %6.2f ms, in %d-step blocks %6.2f ms/step" % (
+            name, step_time * 1e3, n_steps, block_time * 1e3))
+
+
+def bench_ensemble():
+    """
+    Critic forward+backward on a 256-row minibatch: N separate 
+    CriticNetwork calls vs one EnsembleCriticNetwork call (N=2 and N=10), 
+    and the training step time for each ensemble size
+    """
+    import tensorflow as tf
+    from models import CriticNetwork, EnsembleCriticNetwork
+    from HER_SAC_agent import MINIBATCH_SAMPLE_SIZE
+    state_size = OBS_SIZE + GOAL_SIZE
+    states = tf.random.normal((MINIBATCH_SAMPLE_SIZE, state_size))
+    actions = tf.random.normal((MINIBATCH_SAMPLE_SIZE, ACTION_SIZE))
+    input_dim = (state_size + ACTION_SIZE,)
+    for n_critics in (2, 10):
+        critics = [CriticNetwork(input_dim) for _ in range(n_critics)]
+        ensemble = EnsembleCriticNetwork(input_dim, n_critics)
+
+        @tf.function
+        def separate():
+            with tf.GradientTape() as tape:
+                loss = tf.add_n([tf.reduce_mean(critic(states, actions)) for critic in critics])
+            return tape.gradient(loss, [w for c in critics for w in c.trainable_variables])
+
+        @tf.function
+        def stacked():
+            with tf.GradientTape() as tape:
+                loss = tf.reduce_mean(ensemble(states, actions))
+            return tape.gradient(loss, ensemble.trainable_variables)
+
+        separate_time = timeit(separate, repeats=500)
+        stacked_time = timeit(stacked, repeats=500)
+        print("N=%-2d critics: separate %7.1f us, ensemble %7.1f us (x%.1f)" % (
+            n_critics, separate_time * 1e6, stacked_time * 1e6, separate_time / stacked_time))
+    her_buffer = random_buffer(BUFFER_SIZE)
+    for n_critics, critic_subset in [(2, 2), (10, 2)]:
+        agent = make_agent(her_buffer, n_critics=n_critics, critic_subset=critic_subset)
+        step_time = timeit(lambda: agent.optimization_steps(50), repeats=5) / 50
+        print("train step, N=%-2d M=%d: %6.2f ms" % (n_critics, critic_subset, step_time * 1e3))
+
+
+def copy_weights(source, target):
+    """
+    Copy the network weights of agent source into agent target
+    """
+    for network in ("actor", "value", "target_value"):
+        getattr(target, network).set_weights(getattr(source, network).get_weights())
+    for source_critic, target_critic in zip(source.critic_networks, target.critic_networks):
+        target_critic.set_weights(source_critic.get_weights())
+
+
+def graph_flops(function, *inputs):
+    """
+    Float operations of the graph of function traced on inputs
+    """
+    import tensorflow as tf
+    from tensorflow.python.profiler import model_analyzer, option_builder
+    graph = tf.function(function).get_concrete_function(*inputs).graph
+    options = option_builder.ProfileOptionBuilder.float_operation()
+    options['output'] = 'none'
+    return model_analyzer.profile(graph, options=options).total_float_ops
+
+
+def bench_single_pass():
+    """
+    Single-pass SAC update vs the sequential one: graph FLOPs and step
+    time (their losses are checked against each other in 
+    tests/test_single_pass.py)
+    """
+    her_buffer = random_buffer(BUFFER_SIZE)
+    agent = make_agent(her_buffer)
+    inputs = agent.train_inputs(*agent.sample_minibatch()[:2])
+
+    results = {}
+    for name, single_pass in [("sequential", False), ("single-pass", True)]:
+        candidate = make_agent(her_buffer, single_pass=single_pass)
+        flops = graph_flops(candidate._sac_update, *inputs)
+        results[name] = timeit(lambda: candidate.train_step(*inputs), repeats=TRAIN_STEPS * 3)
+        print("%-11s %6.1f MFLOP/step, %5.2f ms/step (x%.2f)" % (name, flops / 1e6, 
+              results[name] * 1e3, results["sequential"] / results[name]))
+
+
+def bench_mixed_precision():
+    """
+    Training step time in float32 and in the mixed-precision modes, and
+    sampling + preprocessing time and memory of a buffer storing the 
+    states in float32, float16 and bfloat16
+    """
+    her_buffer = random_buffer(BUFFER_SIZE)
+    for precision in ("float32", "mixed_bfloat16", "mixed_float16"):
+        agent = make_agent(her_buffer, precision=precision)
+        step_time = timeit(agent.optimization, repeats=TRAIN_STEPS)
+        print("%-15s train step %6.2f ms" % (precision, step_time * 1e3))
+    for state_dtype in ("float32", "float16", "bfloat16"):
+        state_buffer = random_buffer(BUFFER_SIZE, state_dtype=state_dtype)
+        agent = make_agent(state_buffer)
+        sample_time = timeit(lambda: agent.train_inputs(*agent.sample_minibatch()[:2]))
+        print("%-8s states: %6.1f MB, sample+preprocess %6.1f us" % (state_dtype, 
+              (state_buffer.states.nbytes + state_buffer.new_states.nbytes) / 2**20,
+              sample_time * 1e6))
+
+
+def distributed_learner(n_replicas, results):
+    """
+    Time the training steps of a learner on n_replicas CPU replicas, and
+    compare its critics after one step with a single-device learner on 
+    the same minibatch (the critic update does not depend on the sampled
+    actions). Run in a new process: the devices are set at TF startup
+    """
+    from distribute import make_strategy
+    strategy = make_strategy(n_replicas)
+    her_buffer = random_buffer(BUFFER_SIZE)
+    agent = make_agent(her_buffer, strategy=strategy)
+    reference = make_agent(her_buffer)
+    copy_weights(agent, reference)
+    inputs = agent.train_inputs(*agent.sample_minibatch()[:2])
+    agent.train_step(*inputs)
+    reference.train_step(*inputs)
+    critic_diff = max(np.max(np.abs(weights - reference_weights)) 
+                      for critic, reference_critic in zip(agent.critic_networks, 
+                                                          reference.critic_networks)
+                      for weights, reference_weights in zip(critic.get_weights(), 
+                                                            reference_critic.get_weights()))
+    step_time = timeit(agent.optimization, repeats=TRAIN_STEPS)
+    results.put((agent.minibatch_size, step_time, critic_diff))
+
+
+def bench_distributed():
+    """
+    Data-parallel learner on 1, 2 and 4 CPU replicas (MirroredStrategy),
+    with MINIBATCH_SAMPLE_SIZE items per replica: step time, throughput
+    and max difference of the critics with a single-device step
+    """
+    context = mp.get_context("spawn")
+    results = context.Queue()
+    for n_replicas in (1, 2, 4):
+        process = context.Process(target=distributed_learner, args=(n_replicas, results))
+        process.start()
+        minibatch_size, step_time, critic_diff = results.get()
+        process.join()
+        print("%d replicas, minibatch %4d: %6.2f ms/step, %7.0f samples/s, critics diff %.1e" % 
+              (n_replicas, minibatch_size, step_time * 1e3, minibatch_size / step_time, critic_diff))
+
+
+BENCHMARKS = {
+    "relabel": bench_relabel,
+    "train_step": bench_train_step,
+    "train_block": bench_train_block,
+    "collection": bench_collection,
+    "policy_server": bench_policy_server,
+    "actor_inference": bench_actor_inference,
+    "preprocess": bench_preprocess,
+    "normalizer_stats": bench_normalizer_stats,
+    "prioritized": bench_prioritized,
+    "ere": bench_ere,
+    "memmap": bench_memmap,
+    "snapshot": bench_snapshot,
+    "checkpoint": bench_checkpoint,
+    "prefetch": bench_prefetch,
+    "resident": bench_resident,
+    "ensemble": bench_ensemble,
+    "single_pass": bench_single_pass,
+    "mixed_precision": bench_mixed_precision,
+    "distributed": bench_distributed,
+}
+
+# _____________________________________________________ Main _____________________________________________________ #
+
+
+if __name__ == '__main__':
+
+    names = sys.argv[1:] if len(sys.argv) > 1 else list(BENCHMARKS)
+    for name in names:
+        print("\n___________ ", name, " ___________")
+        BENCHMARKS[name]()
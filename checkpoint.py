@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import json
+import numpy as np
+import tensorflow as tf
+from concurrent.futures import ThreadPoolExecutor
+
+from snapshot import write_snapshot, has_snapshot
+
+
+"""
+Checkpoints of the whole training state, in a directory laid out as:
+- tf/ckpt-N.*: networks, optimizer slots and log_temperature
+  (tf.train.Checkpoint, the last max_to_keep of them)
+- state-N.npz: normalizer statistics of checkpoint N
+- state-N.json: training counters and buffer counters (cursor, size)
+  of checkpoint N, written last (checkpoint N is complete when it exists)
+- buffer/: incremental snapshot of the HER buffer, shared by all the
+  checkpoints (it holds the rows of the latest one, and its header may
+  be ahead of the latest complete checkpoint after a crash)
+Restoring checkpoint N restores the buffer counters of checkpoint N: 
+the buffer has the same cursor and size, and the same rows except, in a
+full ring buffer, the oldest slots overwritten by the later checkpoints
+Saving copies the training state in the calling thread and writes it
+in a background thread
+"""
+
+
+# Checkpoint parameters
+MAX_TO_KEEP = 3
+
+
+class TrainingCheckpointer:
+
+    def __init__(self, agent, directory, max_to_keep=MAX_TO_KEEP):
+        """
+        Parameters
+        ----------
+        agent: the HER_SAC_Agent to checkpoint (with its her buffer)
+        directory: directory of the checkpoints
+        max_to_keep: number of checkpoints to retain
+        """
+        self.agent = agent
+        self.directory = directory
+        self.buffer_directory = os.path.join(directory, "buffer")
+        tracked = {'actor': agent.actor, 'value': agent.value, 
+                   'target_value': agent.target_value,
+                   'actor_optimizer': agent.actor_optimizer,
+                   'value_optimizer': agent.value_optimizer}
+        if agent.n_critics == 2:
+            tracked.update({'critic_1': agent.critic_1, 'critic_2': agent.critic_2,
+                            'critic1_optimizer': agent.critic1_optimizer,
+                            'critic2_optimizer': agent.critic2_optimizer})
+        else:
+            tracked.update({'critics': agent.critics, 
+                            'critic_optimizer': agent.critic_optimizer})
+        if agent.auto_temperature:
+            tracked['log_temperature'] = agent.log_temperature
+            tracked['temperature_optimizer'] = agent.temperature_optimizer
+        self.checkpoint = tf.train.Checkpoint(**tracked)
+        self.manager = tf.train.CheckpointManager(self.checkpoint,
+                                                  os.path.join(directory, "tf"),
+                                                  max_to_keep=max_to_keep)
+        self.options = tf.train.CheckpointOptions(experimental_enable_async_checkpoint=True)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+
+    def save(self, counters):
+        """
+        Save a checkpoint without waiting for the disk writes
+
+        Parameters
+        ----------
+        counters: json-serializable dict of the training loop counters
+            (e.g. epoch, cycle, epsilon)
+
+        Returns
+        -------
+        number of the checkpoint
+        """
+        # copies of the training state, in the training thread (after 
+        # the writes of the previous checkpoint)
+        self.wait()
+        numbers = self._numbers()
+        number = numbers[-1] + 1 if numbers else 0
+        buffer_snapshot = self.agent.her_buffer.collect_snapshot(self.buffer_directory)
+        normalizers = self.agent.normalizer_state()
+        counters = dict(counters, played_episodes=self.agent.played_episodes,
+                        eval_episodes=self.agent.eval_episodes, 
+                        buffer=buffer_snapshot.header)
+        self.manager.save(checkpoint_number=number, options=self.options)
+
+        # writes, in the background thread
+        self.pending = self.executor.submit(self._write, number, buffer_snapshot,
+                                            normalizers, counters)
+        return number
+
+    def restore(self, number=None):
+        """
+        Restore a checkpoint (default: the latest complete one)
+
+        Returns
+        -------
+        counters passed to save, None if there is no checkpoint
+        """
+        self.wait()
+        numbers = self._numbers()
+        if not numbers:
+            return None
+        if number is None:
+            number = numbers[-1]
+        self.checkpoint.restore(os.path.join(self.directory, "tf", "ckpt-%d" % number))
+        with np.load(self._path(number, ".npz")) as normalizers:
+            self.agent.load_normalizer_state(dict(normalizers))
+        with open(self._path(number, ".json")) as counters_file:
+            counters = json.load(counters_file)
+        if has_snapshot(self.buffer_directory):
+            self.agent.her_buffer.restore(self.buffer_directory, counters.pop('buffer'))
+        self.agent.played_episodes = counters.pop('played_episodes')
+        self.agent.eval_episodes = counters.pop('eval_episodes')
+        return counters
+
+    def wait(self):
+        """
+        Wait for the pending writes
+        """
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+        self.checkpoint.sync()
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+    def _write(self, number, buffer_snapshot, normalizers, counters):
+        write_snapshot(buffer_snapshot)
+        np.savez(self._path(number, ".npz"), **normalizers)
+        with open(self._path(number, ".json.tmp"), "w") as counters_file:
+            json.dump(counters, counters_file)
+        self.checkpoint.sync()
+        os.replace(self._path(number, ".json.tmp"), self._path(number, ".json"))
+
+        # retention: drop the state files of the checkpoints deleted by the manager
+        kept = {int(path.rsplit("-", 1)[1]) for path in self.manager.checkpoints}
+        for old in self._numbers():
+            if old not in kept:
+                for extension in (".npz", ".json"):
+                    os.remove(self._path(old, extension))
+
+    def _numbers(self):
+        """
+        Sorted numbers of the complete checkpoints
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        matches = [re.fullmatch(r"state-(\d+)\.json", name)
+                   for name in os.listdir(self.directory)]
+        return sorted(int(match.group(1)) for match in matches if match)
+
+    def _path(self, number, extension):
+        return os.path.join(self.directory, "state-%d%s" % (number, extension))
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import pytest
+
+from goal_env import OBS_SIZE, GOAL_SIZE, ACTION_SIZE
+from HER import HER_Buffer, Experience
+
+
+"""
+Shared fixtures of the tests (this file also puts the repository root
+on sys.path, so that plain `pytest` finds the modules)
+"""
+
+
+def random_buffer(size, state_size=OBS_SIZE + GOAL_SIZE, action_size=ACTION_SIZE,
+                  seed=0, n_items=None, **kwargs):
+    """
+    HER_Buffer filled with random transitions, with the state and action
+    sizes of PointGoalEnv by default
+
+    Parameters
+    ----------
+    size: capacity of the buffer
+    state_size: size of the states||goals
+    action_size: size of the actions
+    seed: seed of the random transitions
+    n_items: number of transitions stored (default: size)
+    kwargs: HER_Buffer parameters (prioritized replay, state_dtype)
+
+    Returns
+    -------
+    her_buffer: the filled HER_Buffer
+    """
+    n = size if n_items is None else n_items
+    rng = np.random.default_rng(seed)
+    her_buffer = HER_Buffer(size, **kwargs)
+    her_buffer.store_batch(Experience(rng.standard_normal((n, state_size), np.float32),
+                                      rng.uniform(-1, 1, (n, action_size)).astype(np.float32),
+                                      -rng.integers(0, 2, n).astype(np.float32),
+                                      rng.standard_normal((n, state_size), np.float32),
+                                      np.zeros(n, np.float32)))
+    return her_buffer
+
+
+@pytest.fixture
+def filled_buffer():
+    """
+    Factory of HER_Buffers filled with random transitions (see random_buffer)
+    """
+    return random_buffer
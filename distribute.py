@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import tensorflow as tf
+
+
+"""
+Data-parallel training with tf.distribute: the CPU of a node is split
+into logical devices, one replica each (MirroredStrategy), and several
+workers are joined with MultiWorkerMirroredStrategy (cluster from the
+TF_CONFIG environment variable, one CPU replica per worker: a worker 
+per node). HER_SAC_Agent(strategy=...) mirrors its
+variables on the replicas and splits each minibatch across them
+"""
+
+
+def make_strategy(n_replicas=1, multi_worker=False):
+    """
+    Split the CPU into n_replicas logical devices and build the strategy
+    replicating the training on them, or the strategy of a multi-worker
+    cluster (must be called before any other TensorFlow operation)
+
+    Parameters
+    ----------
+    n_replicas: number of replicas on this node
+    multi_worker: True to synchronize this worker with the others of the
+        TF_CONFIG cluster (n_replicas must be 1)
+
+    Returns
+    -------
+    MirroredStrategy or MultiWorkerMirroredStrategy
+    """
+    if n_replicas < 1:
+        raise ValueError("n_replicas must be positive")
+    if multi_worker:
+        if n_replicas != 1:
+            raise ValueError("MultiWorkerMirroredStrategy runs one CPU replica per worker")
+        return tf.distribute.MultiWorkerMirroredStrategy()
+    cpu = tf.config.list_physical_devices('CPU')[0]
+    tf.config.set_logical_device_configuration(
+        cpu, [tf.config.LogicalDeviceConfiguration()] * n_replicas)
+    devices = [device.name for device in tf.config.list_logical_devices('CPU')]
+    return tf.distribute.MirroredStrategy(devices)
+
+
+def is_multi_worker(strategy):
+    """
+    True if strategy has replicas on other workers
+    """
+    return strategy.num_replicas_in_sync > len(strategy.extended.worker_devices)
+
+
+def host_all_reduce(strategy, arrays, reduce_op="SUM"):
+    """
+    Reduce host arrays over the workers of strategy, each worker passing
+    its own values (e.g. to apply the same normalizer update on all of
+    them). Every worker must make the same calls, in the same order
+
+    Parameters
+    ----------
+    strategy: tf.distribute strategy
+    arrays: list of arrays
+    reduce_op: 'SUM' or 'MAX'
+
+    Returns
+    -------
+    list of float64 arrays
+    """
+    n_local = len(strategy.extended.worker_devices)
+
+    def worker_values(context):
+        values = [np.asarray(array, np.float64) for array in arrays]
+        # one contribution per worker to the sums
+        if reduce_op == "SUM" and context.replica_id_in_sync_group % n_local != 0:
+            values = [np.zeros_like(value) for value in values]
+        # there is no MAX reduction: the values are gathered over the replicas
+        if reduce_op == "MAX":
+            values = [value[np.newaxis] for value in values]
+        return [tf.constant(value) for value in values]
+
+    def reduce(values):
+        context = tf.distribute.get_replica_context()
+        if reduce_op == "MAX":
+            return [tf.reduce_max(context.all_gather(value, axis=0), axis=0) for value in values]
+        return context.all_reduce(tf.distribute.ReduceOp.SUM, values)
+
+    values = strategy.experimental_distribute_values_from_function(worker_values)
+    reduced = strategy.run(reduce, args=(values,))
+    return [strategy.experimental_local_results(value)[0].numpy() for value in reduced]
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+import numpy as np
+from gym import spaces
+from gym.envs.registration import EnvSpec
+
+
+# Env parameters
+OBS_SIZE = 25
+GOAL_SIZE = 3
+ACTION_SIZE = 4
+MAX_EPISODE_STEPS = 50
+DISTANCE_THRESHOLD = 0.05
+STEP_SIZE = 0.05
+
+
+class PointGoalEnv:
+    """
+    Lightweight stand-in for the Fetch GoalEnvs that does not need MuJoCo.
+    A point is moved by the first GOAL_SIZE components of the action toward
+    a random goal; observations, spaces, sparse reward and step API follow
+    FetchPush-v1, so the agent and the buffers can be exercised without it
+    """
+
+    def __init__(self, obs_size=OBS_SIZE, goal_size=GOAL_SIZE,
+                 action_size=ACTION_SIZE, max_episode_steps=MAX_EPISODE_STEPS):
+        self.obs_size = obs_size
+        self.goal_size = goal_size
+        self.spec = EnvSpec("PointGoal-v0", entry_point="goal_env:PointGoalEnv",
+                            max_episode_steps=max_episode_steps)
+        self.observation_space = spaces.Dict({
+            'observation': spaces.Box(-np.inf, np.inf, (obs_size,), np.float32),
+            'achieved_goal': spaces.Box(-np.inf, np.inf, (goal_size,), np.float32),
+            'desired_goal': spaces.Box(-np.inf, np.inf, (goal_size,), np.float32)})
+        self.action_space = spaces.Box(-1., 1., (action_size,), np.float32)
+        self.np_random = np.random.default_rng()
+        self.position = np.zeros(goal_size)
+        self.goal = np.zeros(goal_size)
+
+    def seed(self, seed=None):
+        self.np_random = np.random.default_rng(seed)
+        self.action_space.seed(seed)
+        return [seed]
+
+    def reset(self):
+        self.position = self.np_random.uniform(-0.15, 0.15, self.goal_size)
+        self.goal = self.np_random.uniform(-0.15, 0.15, self.goal_size)
+        return self._get_obs()
+
+    def step(self, action):
+        action = np.clip(action, self.action_space.low, self.action_space.high)
+        self.position = self.position + STEP_SIZE * action[:self.goal_size]
+        obs = self._get_obs()
+        reward = self.compute_reward(obs['achieved_goal'], self.goal, None)
+        info = {'is_success': float(reward == 0)}
+        return obs, reward, False, info
+
+    def compute_reward(self, achieved_goal, desired_goal, info):
+        distance = np.linalg.norm(achieved_goal - desired_goal, axis=-1)
+        return -(distance > DISTANCE_THRESHOLD).astype(np.float32)
+
+    def render(self, mode='human'):
+        if mode == 'rgb_array':
+            return np.zeros((64, 64, 3), np.uint8)
+
+    def close(self):
+        pass
+
+    def _get_obs(self):
+        observation = np.zeros(self.obs_size)
+        observation[:self.goal_size] = self.position
+        observation[self.goal_size:2*self.goal_size] = self.goal - self.position
+        return {'observation': observation,
+                'achieved_goal': self.position.copy(),
+                'desired_goal': self.goal.copy()}
@@ -5,16 +5,20 @@
 
 # Learning
 import gym
-import tensorflow as tf
 from tensorboardX import SummaryWriter
 
 # Math 
-import random
 import numpy as np
 
 # Custom libraries
-from HER import HER_Buffer, Experience
+from HER import HER_Buffer, HER_Memmap_Buffer, HER_Tensor_Buffer, HER_Episode_Buffer, episode_arrays, relabel_episode
 from HER_SAC_agent import HER_SAC_Agent
+from vec_env import VecGoalEnv, SubprocVecGoalEnv
+from rollout_workers import RolloutWorkerPool
+from recorder import FrameRecorder
+from policy_server import PolicyServer, evaluate
+from checkpoint import TrainingCheckpointer
+from distribute import make_strategy
 
 # ___________________________________________________ Parameters ___________________________________________________ #
 
@@ -26,6 +30,14 @@ FRANCESCO_LOG_DIR = "/home/francesco/Scrivania/Test"
 LOG_DIR = GIANFRANCO_LOG_DIR
 EPISODE_LEN = 50
 ENV_WRAPPED = True
+N_ENVS = 1                  # > 1: each cycle plays N_ENVS episodes in lockstep
+SUBPROC_ENVS = False        # True: one worker process per env
+ASYNC_ROLLOUTS = False      # True: rollout processes collect while the learner optimizes
+N_ROLLOUT_WORKERS = 4
+RENDER = "never"            # 'never' (headless), 'eval', 'every_n' or 'record'
+RENDER_EVERY = 10
+VIDEO_DIR = LOG_DIR + "/videos"
+EVAL_SERVER = False         # True: concurrent evaluation envs sharing a policy server (no rendering)
 
 # Training 
 TRAINING_EPOCHES = 200
@@ -33,15 +45,27 @@ N_CYCLES = 50
 CYCLE_EPISODES = 1
 TRAINING_START_STEPS = 1000
 OPTIMIZATION_STEPS = 50
+PREFETCH = False            # True: per-step updates fed by a background minibatch prefetcher
 EVAL_EPISODES = 10
+CHECKPOINT_DIR = LOG_DIR + "/checkpoints"   # resumed from the latest checkpoint if any
+CHECKPOINT_EVERY = 10       # cycles
+MAX_CHECKPOINTS = 3
 
 # HER 
 HER_CAPACITY = 1000000
 MINIBATCH_SAMPLE_SIZE = 256
 STRATEGY = "future"
 FUTURE_K = 4
+HER_STORAGE = "episode"     # 'transition' (K+1 copies per step), 'episode' or 'tensor'
+                            # (transitions in tf.Variables sampled in graph, needs IN_GRAPH_NORM)
+HER_DIRECTORY = None        # directory of a disk-backed 'transition' buffer (reopened if it exists)
+PRIORITIZED = False         # True: prioritized replay ('transition' storage only)
+PER_ALPHA = 0.6
+PER_BETA = 0.4              # annealed to 1 over the training epochs
+STATE_DTYPE = "float32"     # storage of the buffer states: 'float32', 'float16' or 'bfloat16'
 
 # ERE
+ERE = True                  # False: uniform sampling (needed with PRIORITIZED)
 CMIN = 5000
 ETA = 0.922
 
@@ -49,6 +73,15 @@ ETA = 0.922
 EPSILON_START = 1.
 EPSILON_NEXT = 0.
 TEMPERATURE = "auto"
+IN_GRAPH_NORM = False       # True: normalizer statistics applied by the networks
+N_CRITICS = 2               # critic ensemble size (2: twin critics)
+CRITIC_SUBSET = 2           # < N_CRITICS: REDQ-style min over a random subset of critics
+SINGLE_PASS = True          # all the SAC losses from one actor pass (False: sequential updates)
+PRECISION = "float32"       # 'mixed_bfloat16' (CPUs with bf16 support, TPUs) or 
+                            # 'mixed_float16' (GPUs: no fast float16 matmuls on CPU)
+N_REPLICAS = 1              # > 1: data-parallel learner on N_REPLICAS CPU replicas, with
+                            # minibatches of N_REPLICAS*256 items
+MULTI_WORKER = False        # True: one replica per worker of the TF_CONFIG cluster
 
 # ____________________________________________________ Classes ____________________________________________________ #
 
@@ -70,78 +103,126 @@ class DoneOnSuccessWrapper(gym.Wrapper):
         return obs, reward, done, info
 
     def compute_reward(self, achieved_goal, desired_goal, info):
+        # vectorised: also accepts [N, goal_size] arrays of goals
         reward = self.env.compute_reward(achieved_goal, desired_goal, info)
         return reward + self.reward_offset
 
+# ___________________________________________________ Functions ___________________________________________________ #
+
+
+def make_env():
+    env = gym.make(ENV_NAME)
+    if ENV_WRAPPED:
+        env = DoneOnSuccessWrapper(env)
+    return env
+
 # _____________________________________________________ Main _____________________________________________________ #
 
 
 if __name__ == '__main__':
 
+    # Learner devices (before any TensorFlow operation)
+    learner_strategy = None
+    if N_REPLICAS > 1 or MULTI_WORKER:
+        learner_strategy = make_strategy(N_REPLICAS, multi_worker=MULTI_WORKER)
+
     # Environment initialization
-    env = gym.make(ENV_NAME)
-    if ENV_WRAPPED:
-        env = DoneOnSuccessWrapper(env)
+    env = make_env()
+    if N_ENVS > 1:
+        VecEnv = SubprocVecGoalEnv if SUBPROC_ENVS else VecGoalEnv
+        vec_env = VecEnv([make_env] * N_ENVS)
 
     # Agent initialization
-    her_buff = HER_Buffer(HER_CAPACITY)
-    agent = HER_SAC_Agent(env, her_buff, temperature=TEMPERATURE)
-
-    # Summary writer for live trends
-    writer = SummaryWriter(log_dir=LOG_DIR, comment="NoComment")
+    if HER_STORAGE not in ("transition", "episode", "tensor"):
+        raise ValueError("Wrong HER_STORAGE. [available 'transition', 'episode', 'tensor']")
+    if HER_STORAGE != "transition" and PRIORITIZED:
+        raise ValueError("PRIORITIZED needs the 'transition' HER_STORAGE")
+    if HER_STORAGE != "transition" and HER_DIRECTORY is not None:
+        raise ValueError("HER_DIRECTORY needs the 'transition' HER_STORAGE")
+    if HER_STORAGE == "episode":
+        her_buff = HER_Episode_Buffer(HER_CAPACITY, EPISODE_LEN, env.compute_reward,
+                                      strategy=STRATEGY, replay_k=FUTURE_K, 
+                                      state_dtype=STATE_DTYPE)
+    elif HER_STORAGE == "tensor":
+        her_buff = HER_Tensor_Buffer(HER_CAPACITY, state_dtype=STATE_DTYPE)
+    elif HER_DIRECTORY is not None:
+        her_buff = HER_Memmap_Buffer(HER_CAPACITY, HER_DIRECTORY, prioritized=PRIORITIZED, 
+                                     alpha=PER_ALPHA, beta=PER_BETA, state_dtype=STATE_DTYPE)
+    else:
+        her_buff = HER_Buffer(HER_CAPACITY, prioritized=PRIORITIZED, alpha=PER_ALPHA, 
+                              beta=PER_BETA, state_dtype=STATE_DTYPE)
+    recorder = FrameRecorder(VIDEO_DIR) if RENDER == "record" else None
+    agent = HER_SAC_Agent(env, her_buff, temperature=TEMPERATURE, render=RENDER,
+                          render_every=RENDER_EVERY, recorder=recorder, 
+                          in_graph_norm=IN_GRAPH_NORM, n_critics=N_CRITICS, 
+                          critic_subset=CRITIC_SUBSET, single_pass=SINGLE_PASS,
+                          precision=PRECISION, strategy=learner_strategy)
 
-    # Pre-training initialization
+    # Pre-training initialization (or resume from the latest checkpoint)
     iterations = 0
     loss_vect = []
     reward_vect = []
     epsilon = EPSILON_START
+    box_displ = 0
+    start_epoch, start_cycle = 0, 0
+    checkpoint_dir = CHECKPOINT_DIR
+    if MULTI_WORKER:
+        # every worker has its own buffer, normalizer samples and counters
+        checkpoint_dir += "/worker-%d" % learner_strategy.cluster_resolver.task_id
+    checkpointer = TrainingCheckpointer(agent, checkpoint_dir, max_to_keep=MAX_CHECKPOINTS)
+    counters = checkpointer.restore()
+    if counters is not None:
+        start_epoch, start_cycle = counters['epoch'], counters['cycle']
+        iterations = counters['iterations']
+        epsilon = counters['epsilon']
+        box_displ = counters['box_displ']
+        reward_vect = counters['reward_vect']
+        print("Resuming from epoch ", start_epoch, "- cycle ", start_cycle)
+
+    if ASYNC_ROLLOUTS:
+        rollout_pool = RolloutWorkerPool(make_env, agent, N_ROLLOUT_WORKERS)
+        rollout_pool.publish(epsilon=epsilon)
+    if EVAL_SERVER:
+        policy_server = PolicyServer(agent)
+        eval_envs = [make_env() for _ in range(EVAL_EPISODES)]
+
+    # Summary writer for live trends
+    writer = SummaryWriter(log_dir=LOG_DIR, comment="NoComment")
 
     # Training 
-    for epoch in range(TRAINING_EPOCHES):
+    for epoch in range(start_epoch, TRAINING_EPOCHES):
         #print("\n\n___________ TRAINING EPOCH ", epoch, "___________\n")
-        box_displ = 0
+        if PRIORITIZED:
+            her_buff.beta = PER_BETA + (1. - PER_BETA) * epoch / TRAINING_EPOCHES
 
         ## play batch of cycles
-        for cycle in range(N_CYCLES):
+        for cycle in range(start_cycle if epoch == start_epoch else 0, N_CYCLES):
             print("Epoch ", epoch, "- Cycle ", cycle)
-            hindsight_experiences = []
             played_experiences = 0
 
             ### play episodes
-            for episode in range(CYCLE_EPISODES):
-                experiences = agent.play_episode(criterion="SAC", epsilon=epsilon)
-                goal = experiences[0].state['desired_goal']
-                iterations += len(experiences)
-                played_experiences += len(experiences)
-                if (agent.env.compute_reward(experiences[0].new_state['achieved_goal'], 
-                                             experiences[-1].new_state['achieved_goal'], 
+            if ASYNC_ROLLOUTS:
+                episodes = rollout_pool.collect(min_episodes=CYCLE_EPISODES)
+            elif N_ENVS > 1:
+                episodes = [episode_arrays(experiences) for experiences in 
+                            agent.play_episodes(vec_env, criterion="SAC", epsilon=epsilon)]
+            else:
+                episodes = [episode_arrays(agent.play_episode(criterion="SAC", epsilon=epsilon))
+                            for episode in range(CYCLE_EPISODES)]
+            for episode in episodes:
+                iterations += len(episode.action)
+                played_experiences += len(episode.action)
+                if (agent.env.compute_reward(episode.achieved_goal[1], 
+                                             episode.achieved_goal[-1], 
                                              None)) == 0:
                     box_displ += 1
-                for t in range(len(experiences)):
-                    reward_vect.append(experiences[t].reward)
-                    achieved_goal = experiences[t].new_state['achieved_goal']
-                    hindsight_exp = agent.getBuffer().store_experience(experiences[t], 
-                                                                    experiences[t].reward, goal)
-                    hindsight_experiences.append(hindsight_exp)
-                    if STRATEGY == "final":
-                        desired_goal = experiences[-1].new_state['achieved_goal']
-                        her_reward = \
-                            agent.env.compute_reward(achieved_goal, desired_goal, None)
-                        hindsight_exp = agent.getBuffer().store_experience(experiences[t], 
-                                                                her_reward, desired_goal)
-                        hindsight_experiences.append(hindsight_exp)
-                    elif STRATEGY == "future":
-                        for f_t in range(FUTURE_K):
-                            future = random.randint(t, (len(experiences)-1))
-                            desired_goal = experiences[future].new_state['achieved_goal']
-                            her_reward = \
-                                agent.env.compute_reward(achieved_goal, desired_goal, None)
-                            hindsight_exp = agent.getBuffer().store_experience(experiences[t],
-                                                                    her_reward, desired_goal)
-                            hindsight_experiences.append(hindsight_exp)
-                    else:
-                        raise TypeError("Wrong strategy for goal sampling." +
-                                        " [available 'final', 'future']")   
+                reward_vect.extend(episode.reward)
+                if HER_STORAGE == "episode":
+                    agent.getBuffer().store_episode(episode)
+                else:
+                    agent.getBuffer().store_batch(
+                        relabel_episode(episode, agent.env.compute_reward,
+                                        strategy=STRATEGY, future_k=FUTURE_K))
 
             ### print results
             if iterations > 2500:
@@ -149,38 +230,69 @@ if __name__ == '__main__':
                 writer.add_scalar("mean_reward", mean_reward, iterations)
 
             ### normalization
-            agent.update_normalizer(batch=hindsight_experiences, hindsight=True)
+            agent.update_normalizer_from_buffer()
 
             ### optimization + ERE 
             if iterations >= TRAINING_START_STEPS:
-                k = 0
                 epsilon = EPSILON_NEXT
                 opt_steps = min(played_experiences, OPTIMIZATION_STEPS)
-                for step in range(opt_steps):
-                    ck = max(HER_CAPACITY*pow(ETA, k*(EPISODE_LEN/opt_steps)), CMIN)
-                    v_loss, c1_loss, c2_loss, act_loss, temp_loss = \
-                        agent.optimization()
-                    agent.soft_update()
-                    k += 1
+                ere_cks = None
+                if ERE:
+                    ere_cks = agent.getBuffer().ere_cks(opt_steps, EPISODE_LEN, 
+                                                        eta=ETA, c_min=CMIN)
+                if PREFETCH:
+                    agent.prefetch(opt_steps, ere_cks=ere_cks)
+                    v_losses, critic_losses, act_losses, temp_losses = \
+                        zip(*[agent.optimization() for step in range(opt_steps)])
+                else:
+                    v_losses, critic_losses, act_losses, temp_losses = \
+                        agent.optimization_steps(opt_steps, ere_cks=ere_cks)
+            if ASYNC_ROLLOUTS:
+                rollout_pool.publish(epsilon=epsilon)
             if TEMPERATURE == "auto":
                 print("\n\tTemperature: ", agent.getTemperature())                  
                 writer.add_scalar("temperature", agent.getTemperature(), iterations)
 
+            ### checkpoint (the training resumes from the next cycle)
+            if (cycle + 1) % CHECKPOINT_EVERY == 0:
+                reward_vect = reward_vect[-2500:]
+                checkpointer.save({'epoch': epoch, 'cycle': cycle + 1, 
+                                   'iterations': iterations, 'epsilon': epsilon, 
+                                   'box_displ': box_displ,
+                                   'reward_vect': [float(reward) for reward in reward_vect]})
+
         ## evaluation
         if ENV_NAME == "FetchPush-v1":
             print("\tBox displacements = ", box_displ)
         print("\n\nEVALUATION\n\n")
         success_rates = []
-        for _ in range(EVAL_EPISODES):
-            experiences = agent.play_episode(criterion="SAC", epsilon=0)
-            total_reward = sum([exp.reward for exp in experiences])
+        if EVAL_SERVER:
+            episode_rewards = evaluate(policy_server, eval_envs, EPISODE_LEN)
+        else:
+            episode_rewards = [[exp.reward for exp in 
+                                agent.play_episode(criterion="SAC", epsilon=0, evaluation=True,
+                                                   deterministic=True)]
+                               for _ in range(EVAL_EPISODES)]
+        for rewards in episode_rewards:
+            total_reward = sum(rewards)
             if ENV_WRAPPED:
-                success_rate = total_reward / len(experiences)
+                success_rate = total_reward / len(rewards)
             else:
-                success_rate = (len(experiences) + total_reward) / len(experiences)
+                success_rate = (len(rewards) + total_reward) / len(rewards)
             success_rates.append(success_rate)
         success_rate = sum(success_rates) / len(success_rates)
         print("Success_rate = ", success_rate)
         if ENV_NAME == "FetchPush-v1":
             writer.add_scalar("box displacements per epoch", box_displ, epoch)
         writer.add_scalar("mean success rate per epoch", success_rate, epoch)
+        if isinstance(her_buff, HER_Memmap_Buffer):
+            her_buff.flush()
+        box_displ = 0
+
+    if ASYNC_ROLLOUTS:
+        rollout_pool.close()
+    if recorder is not None:
+        recorder.close()
+    if EVAL_SERVER:
+        policy_server.close()
+    checkpointer.close()
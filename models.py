@@ -20,18 +20,57 @@ LOG_STD_MIN = -20
 LOG_STD_MAX = 2
 
 
+class InputNormalization(layers.Layer):
+    """
+    In-graph normalization of the state||goal inputs:
+    clip((clip(x, clip_max) - offset) / scale, clip_range).
+    The statistics are non-trainable variables, assigned from the 
+    running normalizers, so they are saved and exported with the networks
+    """
+
+    def __init__(self, size, clip_range=np.inf, clip_max=np.inf, **kwargs):
+        super(InputNormalization, self).__init__(**kwargs)
+        self.offset = self.add_weight(name="offset", shape=(size,), trainable=False,
+                                      initializer="zeros")
+        self.scale = self.add_weight(name="scale", shape=(size,), trainable=False,
+                                     initializer="ones")
+        self.clip_range = self.add_weight(name="clip_range", shape=(size,), trainable=False,
+                                          initializer=tf.keras.initializers.Constant(clip_range))
+        self.clip_max = self.add_weight(name="clip_max", shape=(), trainable=False,
+                                        initializer=tf.keras.initializers.Constant(clip_max))
+
+    def call(self, x):
+        x = tf.clip_by_value(x, -self.clip_max, self.clip_max)
+        x = (x - self.offset) / self.scale
+        return tf.clip_by_value(x, -self.clip_range, self.clip_range)
+
+    def update(self, offset, scale, clip_range):
+        self.offset.assign(offset)
+        self.scale.assign(scale)
+        self.clip_range.assign(np.broadcast_to(clip_range, self.clip_range.shape))
+
+
+"""
+Mixed precision: the networks take a Keras dtype policy (e.g. 
+'mixed_bfloat16') for their hidden layers. The inputs are normalized and 
+the outputs (policy mean and log std, Q values, values) computed in 
+float32, so that log-probabilities and targets keep full precision
+"""
+
+
 class ActorNetwork(Model):
 
-    def __init__(self, input_dim, action_dim):
+    def __init__(self, input_dim, action_dim, normalizer=None, dtype=None):
         super(ActorNetwork, self).__init__()
+        self.normalizer = normalizer
         self.input_layer = layers.InputLayer(input_shape=input_dim)
-        self.layer_1 = layers.Dense(ACTOR_DENSE_1, activation=layers.ReLU())
-        self.layer_2 = layers.Dense(ACTOR_DENSE_2, activation=layers.ReLU())
-        self.mean = layers.Dense(action_dim)
-        self.log_std_dev = layers.Dense(action_dim)
+        self.layer_1 = layers.Dense(ACTOR_DENSE_1, activation=layers.ReLU(dtype=dtype), dtype=dtype)
+        self.layer_2 = layers.Dense(ACTOR_DENSE_2, activation=layers.ReLU(dtype=dtype), dtype=dtype)
+        self.mean = layers.Dense(action_dim, dtype="float32")
+        self.log_std_dev = layers.Dense(action_dim, dtype="float32")
 
     def call(self, state, noisy=True):
-        x = self.layer_2(self.layer_1(self.input_layer(state)))
+        x = self.layer_2(self.layer_1(self._normalize(state)))
         mean = self.mean(x)
         log_std = self.log_std_dev(x)
         log_std_clipped = tf.clip_by_value(log_std, LOG_STD_MIN, LOG_STD_MAX)
@@ -47,39 +86,110 @@ class ActorNetwork(Model):
         logprob = tf.reduce_sum(logprob, axis=1, keepdims=True)
         return squashed_actions, logprob
 
+    @tf.function(reduce_retracing=True)
+    def act(self, state, deterministic=False):
+        """
+        Fast inference path: only the action, without distribution objects 
+        and log-probabilities. The action is tanh(mean) if deterministic, 
+        otherwise it is sampled from the squashed gaussian policy
+        """
+        x = self.layer_2(self.layer_1(self._normalize(state)))
+        mean = self.mean(x)
+        if deterministic:
+            return tf.tanh(mean)
+        log_std = self.log_std_dev(x)
+        log_std_clipped = tf.clip_by_value(log_std, LOG_STD_MIN, LOG_STD_MAX)
+        noise = tf.random.normal(tf.shape(mean))
+        return tf.tanh(mean + noise*tf.exp(log_std_clipped))
+
+    def _normalize(self, state):
+        x = self.input_layer(state)
+        if self.normalizer is not None:
+            x = self.normalizer(x)
+        return x
+
 
 class CriticNetwork(Model):
 
-    def __init__(self, input_dim):
+    def __init__(self, input_dim, normalizer=None, dtype=None):
         super(CriticNetwork, self).__init__()
+        self.normalizer = normalizer
 
         self.net = Sequential()
         self.net.add(layers.InputLayer(input_shape=input_dim))
-        self.net.add(layers.Dense(CRITIC_DENSE_1))
-        self.net.add(layers.ReLU())
-        self.net.add(layers.Dense(CRITIC_DENSE_2))
-        self.net.add(layers.ReLU())
-        self.net.add(layers.Dense(1))
+        self.net.add(layers.Dense(CRITIC_DENSE_1, dtype=dtype))
+        self.net.add(layers.ReLU(dtype=dtype))
+        self.net.add(layers.Dense(CRITIC_DENSE_2, dtype=dtype))
+        self.net.add(layers.ReLU(dtype=dtype))
+        self.net.add(layers.Dense(1, dtype="float32"))
 
     def call(self, state, action):
+        if self.normalizer is not None:
+            state = self.normalizer(state)
         state_action = tf.concat([state, action], axis=1)
         q_value = self.net(state_action)
         return q_value
 
 
+class EnsembleCriticNetwork(Model):
+    """
+    n_critics critic networks with the CriticNetwork architecture, whose
+    weights are stacked along a leading ensemble axis: all the critics are
+    evaluated on the shared state||action input with batched matmuls
+    """
+
+    def __init__(self, input_dim, n_critics=2, normalizer=None, dtype=None):
+        super(EnsembleCriticNetwork, self).__init__()
+        self.normalizer = normalizer
+        self.n_critics = n_critics
+        # float32 variables, hidden layers computed in the policy dtype
+        self.hidden_dtype = tf.keras.mixed_precision.Policy(dtype or "float32").compute_dtype
+        sizes = [input_dim[0], CRITIC_DENSE_1, CRITIC_DENSE_2, 1]
+        self.kernels = []
+        self.biases = []
+        for layer, (fan_in, fan_out) in enumerate(zip(sizes[:-1], sizes[1:])):
+            # glorot uniform limits of each critic's dense layer
+            limit = np.sqrt(6. / (fan_in + fan_out))
+            self.kernels.append(self.add_weight(name="kernel_%d" % layer, 
+                shape=(n_critics, fan_in, fan_out),
+                initializer=tf.keras.initializers.RandomUniform(-limit, limit)))
+            self.biases.append(self.add_weight(name="bias_%d" % layer,
+                shape=(n_critics, 1, fan_out), initializer="zeros"))
+
+    def call(self, state, action):
+        """
+        Returns
+        -------
+        q_values: [n_critics, batch, 1] tensor
+        """
+        if self.normalizer is not None:
+            state = self.normalizer(state)
+        state_action = tf.cast(tf.concat([state, action], axis=1), self.hidden_dtype)
+        kernels = [tf.cast(kernel, self.hidden_dtype) for kernel in self.kernels[:-1]]
+        biases = [tf.cast(bias, self.hidden_dtype) for bias in self.biases[:-1]]
+        x = tf.einsum('bi,nio->nbo', state_action, kernels[0]) + biases[0]
+        for kernel, bias in zip(kernels[1:], biases[1:]):
+            x = tf.matmul(tf.nn.relu(x), kernel) + bias
+        x = tf.cast(tf.nn.relu(x), tf.float32)
+        return tf.matmul(x, self.kernels[-1]) + self.biases[-1]
+
+
 class ValueNetwork(Model):
 
-    def __init__(self, input_dim):
+    def __init__(self, input_dim, normalizer=None, dtype=None):
         super(ValueNetwork, self).__init__()
+        self.normalizer = normalizer
 
         self.net = Sequential()
         self.net.add(layers.InputLayer(input_shape=input_dim))
-        self.net.add(layers.Dense(VALUE_DENSE_1))
-        self.net.add(layers.ReLU())
-        self.net.add(layers.Dense(VALUE_DENSE_2))
-        self.net.add(layers.ReLU())
-        self.net.add(layers.Dense(1))
+        self.net.add(layers.Dense(VALUE_DENSE_1, dtype=dtype))
+        self.net.add(layers.ReLU(dtype=dtype))
+        self.net.add(layers.Dense(VALUE_DENSE_2, dtype=dtype))
+        self.net.add(layers.ReLU(dtype=dtype))
+        self.net.add(layers.Dense(1, dtype="float32"))
     
     def call(self, state):
+        if self.normalizer is not None:
+            state = self.normalizer(state)
         value = self.net(state)
         return value
@@ -21,9 +21,10 @@ class Normalizer:
         self.normalization = normalization
 
         if self.normalization == "Gaussian":
-            self.local_sum = np.zeros(self.size, np.float32)
-            self.local_sumsq = np.zeros(self.size, np.float32)
-            self.local_count = np.zeros(1, np.float32)
+            # running count, mean and sum of squared deviations (float64)
+            self.local_count = 0
+            self.local_mean = np.zeros(self.size, np.float64)
+            self.local_m2 = np.zeros(self.size, np.float64)
             self.mean = np.zeros(self.size, np.float32)
             self.std = np.ones(self.size, np.float32)
         elif self.normalization == "MinMax":
@@ -32,19 +33,109 @@ class Normalizer:
         else:
             raise TypeError("Wrong normalization type")
 
-    def update(self, buffer):
+    def update(self, buffer, all_reduce=None):
+        """
+        Update the statistics with a [samples, size] buffer
+
+        Parameters
+        ----------
+        buffer: samples to add
+        all_reduce: function(arrays, reduce_op) reducing a list of arrays
+            over the workers of a distributed learner ('SUM' or 'MAX', see 
+            distribute.host_all_reduce), so that all of them apply the 
+            update of all their samples (None: local update)
+        """
+        if self.normalization == "Gaussian":
+            buffer = np.asarray(buffer, np.float64).reshape(-1, self.size)
+            count, total = buffer.shape[0], buffer.sum(axis=0)
+            if all_reduce is not None:
+                count, total = all_reduce([count, total], "SUM")
+            if count == 0:
+                return
+            batch_mean = total / count
+            batch_m2 = np.square(buffer - batch_mean).sum(axis=0)
+            if all_reduce is not None:
+                batch_m2, = all_reduce([batch_m2], "SUM")
+            self._combine(int(count), batch_mean, batch_m2)
+        elif self.normalization == "MinMax":
+            buffer = np.asarray(buffer).reshape(-1, self.size)
+            batch_min = buffer.min(axis=0, initial=np.inf)
+            batch_max = buffer.max(axis=0, initial=-np.inf)
+            if all_reduce is not None:
+                batch_min, batch_max = all_reduce([-batch_min, batch_max], "MAX")
+                batch_min = -batch_min
+            self.min = np.minimum(self.min, batch_min).astype(np.float32)
+            self.max = np.maximum(self.max, batch_max).astype(np.float32)
+
+    def merge(self, other):
+        """
+        Merge the statistics of another normalizer of the same type and 
+        size (e.g. of a rollout process) into this one, exactly
+        """
+        if self.normalization != other.normalization or self.size != other.size:
+            raise TypeError("Normalizers with different type or size")
+        if self.normalization == "Gaussian":
+            self._combine(other.local_count, other.local_mean, other.local_m2)
+        elif self.normalization == "MinMax":
+            self.min = np.minimum(self.min, other.min)
+            self.max = np.maximum(self.max, other.max)
+
+    def _combine(self, count, mean, m2):
+        """
+        Chan et al. parallel update of the running (count, mean, M2)
+        with the statistics of another set of samples
+        """
+        if count == 0:
+            return
+        total = self.local_count + count
+        delta = mean - self.local_mean
+        self.local_mean = self.local_mean + delta * (count / total)
+        self.local_m2 = self.local_m2 + m2 + np.square(delta) * (self.local_count * count / total)
+        self.local_count = total
+        self._update_moments()
+
+    def _update_moments(self):
+        """
+        float32 mean and std from the running statistics
+        """
+        self.mean = self.local_mean.astype(np.float32)
+        self.std = np.sqrt(np.maximum(np.square(self.eps), 
+                                      self.local_m2 / self.local_count)).astype(np.float32)
+
+    def get_state(self):
+        """
+        Copy of the statistics, as a dict of arrays (e.g. for np.savez)
+        """
+        if self.normalization == "Gaussian":
+            return {'count': np.array(self.local_count), 'mean': self.local_mean.copy(), 
+                    'm2': self.local_m2.copy()}
+        elif self.normalization == "MinMax":
+            return {'min': self.min.copy(), 'max': self.max.copy()}
+
+    def set_state(self, state):
+        """
+        Restore the statistics returned by get_state
+        """
         if self.normalization == "Gaussian":
-            self.local_sum += buffer.sum(axis=0)
-            self.local_sumsq += (np.square(buffer)).sum(axis=0)
-            self.local_count[0] += buffer.shape[0]
-            self.mean = self.local_sum / self.local_count
-            self.std = np.sqrt(np.maximum(np.square(self.eps), 
-                                          (self.local_sumsq / self.local_count) - 
-                                           np.square(self.local_sum / self.local_count)))
+            self.local_count = int(state['count'])
+            self.local_mean = np.array(state['mean'], np.float64)
+            self.local_m2 = np.array(state['m2'], np.float64)
+            if self.local_count > 0:
+                self._update_moments()
         elif self.normalization == "MinMax":
-            self.min = np.minimum(self.min, buffer.min(axis=0))
-            self.max = np.maximum(self.max, buffer.max(axis=0))
-        
+            self.min = np.array(state['min'], np.float32)
+            self.max = np.array(state['max'], np.float32)
+
+    def affine(self):
+        """
+        Return (offset, scale) such that 
+        normalize(v) = clip((v - offset) / scale, -clip_range, clip_range)
+        """
+        if self.normalization == "Gaussian":
+            return self.mean, self.std
+        elif self.normalization == "MinMax":
+            return self.min, self.max - self.min
+
     def normalize(self, vector, clip_range=None):
         if clip_range is None:
             clip_range = self.clip_range
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+import time
+import queue
+import threading
+import numpy as np
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+# Server parameters
+MAX_BATCH_SIZE = 64
+MAX_LATENCY = 0.002
+POLL_TIMEOUT = 0.1
+LATENCY_WINDOW = 10000
+
+
+class PolicyServer:
+    """
+    Serve the actor of an agent to many concurrent clients: single
+    observation requests are micro-batched (up to max_batch_size, waiting at
+    most max_latency seconds after the first one), normalized with the agent
+    normalizers and answered with one actor forward pass (mean action if
+    deterministic)
+    """
+
+    def __init__(self, agent, max_batch_size=MAX_BATCH_SIZE, max_latency=MAX_LATENCY,
+                 deterministic=True):
+        self.agent = agent
+        self.deterministic = deterministic
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.requests = queue.Queue()
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._serve_loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, observation):
+        """
+        Request an action for a dict observation of a GoalEnv
+
+        Returns
+        -------
+        future: concurrent.futures.Future resolved with the action
+        """
+        future = Future()
+        self.requests.put((observation, future, time.perf_counter()))
+        return future
+
+    def act(self, observation):
+        """
+        Request an action and wait for it
+        """
+        return self.submit(observation).result()
+
+    def latency(self, percentile=99):
+        """
+        Percentile (in seconds) of the latency of the last served requests
+        """
+        return np.percentile(self.latencies, percentile)
+
+    def close(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def _serve_loop(self):
+        while not self.stop_event.is_set():
+            try:
+                batch = [self.requests.get(timeout=POLL_TIMEOUT)]
+            except queue.Empty:
+                continue
+            deadline = batch[0][2] + self.max_latency
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                try:
+                    if timeout > 0:
+                        batch.append(self.requests.get(timeout=timeout))
+                    else:
+                        batch.append(self.requests.get_nowait())
+                except queue.Empty:
+                    break
+            observations, futures, starts = zip(*batch)
+            try:
+                actions = self._forward(observations)
+            except Exception as error:
+                for future in futures:
+                    future.set_exception(error)
+                continue
+            now = time.perf_counter()
+            for future, action, start in zip(futures, actions, starts):
+                future.set_result(action)
+                self.latencies.append(now - start)
+
+    def _forward(self, observations):
+        """
+        Normalize a batch of dict observations and run the actor on it
+        """
+        obs = np.stack([observation['observation'] for observation in observations])
+        goals = np.stack([observation['desired_goal'] for observation in observations])
+        actions = self.agent.actor.act(self.agent.actor_inputs(obs, goals), 
+                                       deterministic=self.deterministic)
+        return actions.numpy()
+
+
+def play_with_server(server, env, max_timesteps):
+    """
+    Play an episode in env asking the actions to the policy server
+
+    Returns
+    -------
+    rewards: the rewards of the episode
+    """
+    state = env.reset()
+    rewards = []
+    done = False
+    while len(rewards) < max_timesteps and not done:
+        state, reward, done, info = env.step(server.act(state))
+        rewards.append(reward)
+    return rewards
+
+
+def evaluate(server, envs, max_timesteps):
+    """
+    Play one episode in each env concurrently, sharing the policy server
+
+    Returns
+    -------
+    rewards of the episodes, one list for each env
+    """
+    with ThreadPoolExecutor(max_workers=len(envs)) as executor:
+        return list(executor.map(lambda env: play_with_server(server, env, max_timesteps),
+                                 envs))
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+import queue
+import threading
+
+
+# Prefetch parameters
+QUEUE_SIZE = 2
+POLL_TIMEOUT = 0.1
+
+
+class MinibatchPrefetcher:
+    """
+    Background thread preparing the minibatches of the next n_steps
+    optimization steps of an agent: sampled (with the ERE range of each
+    step), normalized and converted to contiguous tensors, so that they
+    are ready when HER_SAC_Agent.optimization asks for them.
+    Samples are drawn at most queue_size steps ahead, under a lock that
+    the agent also takes to update the priorities of the buffer
+    """
+
+    def __init__(self, agent, n_steps, ere_cks=None, queue_size=QUEUE_SIZE):
+        """
+        Parameters
+        ----------
+        agent: the HER_SAC_Agent to feed
+        n_steps: number of minibatches to prepare
+        ere_cks: parameters ck of ERE algorithm, one per step (None for
+            uniform sampling)
+        queue_size: maximum number of ready minibatches
+        """
+        self.agent = agent
+        self.n_steps = n_steps
+        self.ere_cks = ere_cks
+        self.remaining = n_steps
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._prefetch_loop, daemon=True)
+        self.thread.start()
+
+    def get(self):
+        """
+        Next ready minibatch
+
+        Returns
+        -------
+        train_step inputs (tensors) and buffer indexes (None unless the
+        buffer is prioritized)
+        """
+        item = self.queue.get()
+        self.remaining -= 1
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def done(self):
+        return self.remaining == 0
+
+    def close(self):
+        """
+        Stop the thread, dropping the minibatches not consumed
+        """
+        self.stop_event.set()
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=POLL_TIMEOUT)
+            except queue.Empty:
+                pass
+        self.thread.join()
+
+    def _prefetch_loop(self):
+        try:
+            for step in range(self.n_steps):
+                ere_ck = None if self.ere_cks is None else self.ere_cks[step]
+                with self.lock:
+                    minibatch, weights, indexes = \
+                        self.agent.sample_minibatch(ere_ck=ere_ck)
+                item = (self.agent.train_inputs(minibatch, weights), indexes)
+                while not self.stop_event.is_set():
+                    try:
+                        self.queue.put(item, timeout=POLL_TIMEOUT)
+                        break
+                    except queue.Full:
+                        pass
+                if self.stop_event.is_set():
+                    return
+        except Exception as error:
+            self.queue.put(error)
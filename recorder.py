@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+import os
+import queue
+import threading
+import numpy as np
+
+try:
+    import imageio
+except ImportError:
+    imageio = None
+
+
+# Recorder parameters
+FPS = 25
+QUEUE_SIZE = 8
+
+
+class FrameRecorder:
+    """
+    Write the rgb frames captured in an episode to disk in a background
+    thread, so that encoding never stalls the training loop.
+    Videos are written as .mp4 with imageio when available, otherwise the
+    raw frames are saved as a compressed .npz
+    """
+
+    def __init__(self, directory, fps=FPS, queue_size=QUEUE_SIZE):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.fps = fps
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+
+    def record(self, frames, name):
+        """
+        Enqueue the frames of an episode to be written as <name>.mp4 (.npz)
+        """
+        self.queue.put((frames, name))
+
+    def close(self):
+        """
+        Wait for the pending episodes to be written
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+    def _write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            frames, name = item
+            path = os.path.join(self.directory, name)
+            if imageio is not None:
+                imageio.mimwrite(path + ".mp4", frames, fps=self.fps)
+            else:
+                np.savez_compressed(path + ".npz", frames=np.stack(frames))
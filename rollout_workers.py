@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+
+import queue
+import numpy as np
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+from HER import Episode
+
+
+"""
+Asynchronous actor-learner collection: a pool of rollout processes, each
+owning an env, plays episodes with the latest published actor while the
+learner optimizes. Episodes and weights are exchanged through shared memory:
+- the actor weights and the normalizer (offset, scale) vectors are packed
+  in one flat float32 array, published with a version counter
+- finished episodes are written in episode slots ([slots, T+1, dim] arrays),
+  whose indexes are passed through the free/filled queues
+"""
+
+
+# Pool parameters
+SLOTS_PER_WORKER = 4
+POLL_TIMEOUT = 0.1
+JOIN_TIMEOUT = 5
+
+
+def _attach(name, shape, dtype):
+    """
+    Attach to a shared memory block and view it as an array
+    """
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _rollout_worker(env_fn, in_graph_norm, actor_shapes, slot_specs, weights_spec,
+                    weights_lock, weights_version, epsilon, free_slots,
+                    filled_slots, stop_event):
+    """
+    Loop of a rollout process: play episodes with the latest published
+    actor and write them in free episode slots
+    """
+    import tensorflow as tf
+    from models import ActorNetwork, InputNormalization
+
+    # one core per rollout process
+    tf.config.threading.set_intra_op_parallelism_threads(1)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    np.random.seed(None)
+    env = env_fn()
+    max_timesteps = env.spec.max_episode_steps
+    obs_size = env.observation_space['observation'].shape[0]
+    goal_size = env.observation_space['desired_goal'].shape[0]
+    action_size = env.action_space.shape[0]
+    input_norm = InputNormalization(obs_size + goal_size) if in_graph_norm else None
+    actor = ActorNetwork((obs_size + goal_size,), action_size, input_norm)
+    actor(tf.zeros((1, obs_size + goal_size)))
+
+    # shared memory views
+    blocks = {key: _attach(*spec) for key, spec in slot_specs.items()}
+    slots = {key: array for key, (_, array) in blocks.items()}
+    weights_shm, weights = _attach(*weights_spec)
+    splits = np.cumsum([int(np.prod(shape)) for shape in actor_shapes] +
+                       [obs_size, obs_size, goal_size, goal_size])
+    version = -1
+
+    try:
+        while not stop_event.is_set():
+            try:
+                slot = free_slots.get(timeout=POLL_TIMEOUT)
+            except queue.Empty:
+                continue
+
+            # pull the latest actor weights and normalizer statistics
+            if weights_version.value != version:
+                with weights_lock:
+                    version = weights_version.value
+                    flat = weights.copy()
+                params = np.split(flat, splits)
+                actor.set_weights([p.reshape(shape) for p, shape in
+                                   zip(params[:len(actor_shapes)], actor_shapes)])
+                if in_graph_norm:
+                    # the actor normalizes its inputs
+                    offset, scale, clip_range = 0.0, 1.0, np.inf
+                else:
+                    offset = np.concatenate([params[-5], params[-3]])
+                    scale = np.concatenate([params[-4], params[-2]])
+                    clip_range = params[-1][0]
+
+            # play the episode straight into the slot
+            state = env.reset()
+            slots['obs'][slot, 0] = state['observation']
+            slots['achieved_goal'][slot, 0] = state['achieved_goal']
+            done = False
+            t = 0
+            while t < max_timesteps and not done:
+                if np.random.random() < epsilon.value:
+                    action = env.action_space.sample()
+                else:
+                    obs_goal = np.concatenate([state['observation'], state['desired_goal']])
+                    obs_goal = np.clip((obs_goal - offset) / scale, -clip_range, clip_range)
+                    action = actor.act(np.array(obs_goal, ndmin=2, dtype=np.float32))
+                    action = action.numpy()[0]
+                new_state, reward, done, info = env.step(action)
+                slots['desired_goal'][slot, t] = state['desired_goal']
+                slots['action'][slot, t] = action
+                slots['reward'][slot, t] = reward
+                slots['done'][slot, t] = done
+                t += 1
+                slots['obs'][slot, t] = new_state['observation']
+                slots['achieved_goal'][slot, t] = new_state['achieved_goal']
+                state = new_state
+            slots['length'][slot] = t
+            filled_slots.put(slot)
+    finally:
+        env.close()
+        weights_shm.close()
+        for shm, _ in blocks.values():
+            shm.close()
+
+
+class RolloutWorkerPool:
+    """
+    Pool of rollout processes pushing finished episodes to the learner
+    """
+
+    def __init__(self, env_fn, agent, n_workers, n_slots=None, start_method="spawn"):
+        """
+        Parameters
+        ----------
+        env_fn: function building an env (picklable, e.g. a module function)
+        agent: the learner HER_SAC_Agent (for sizes, actor and normalizers)
+        n_workers: number of rollout processes
+        n_slots: number of episode slots (default SLOTS_PER_WORKER*n_workers)
+        start_method: multiprocessing start method
+        """
+        context = mp.get_context(start_method)
+        if n_slots is None:
+            n_slots = SLOTS_PER_WORKER * n_workers
+        T = agent.max_timesteps
+        self.agent = agent
+        self.n_slots = n_slots
+
+        # episode slots
+        shapes = {'obs': ((n_slots, T+1, agent.obs_size), np.float32),
+                  'achieved_goal': ((n_slots, T+1, agent.goal_size), np.float32),
+                  'desired_goal': ((n_slots, T, agent.goal_size), np.float32),
+                  'action': ((n_slots, T, agent.action_size), np.float32),
+                  'reward': ((n_slots, T), np.float32),
+                  'done': ((n_slots, T), np.float32),
+                  'length': ((n_slots,), np.int64)}
+        self.shms = []
+        self.slots = {}
+        slot_specs = {}
+        for key, (shape, dtype) in shapes.items():
+            shm, self.slots[key] = self._create(shape, dtype)
+            slot_specs[key] = (shm.name, shape, dtype)
+
+        # actor weights + normalizer statistics
+        actor_shapes = [w.shape for w in agent.actor.get_weights()]
+        size = sum(int(np.prod(shape)) for shape in actor_shapes) + \
+               2 * (agent.obs_size + agent.goal_size) + 1
+        weights_shm, self.weights = self._create((size,), np.float32)
+        weights_spec = (weights_shm.name, (size,), np.float32)
+        self.weights_lock = context.Lock()
+        self.weights_version = context.Value('i', -1, lock=False)
+        self.epsilon = context.Value('d', 0.0, lock=False)
+        self.publish()
+
+        # queues of slot indexes
+        self.free_slots = context.Queue()
+        self.filled_slots = context.Queue()
+        for slot in range(n_slots):
+            self.free_slots.put(slot)
+        self.stop_event = context.Event()
+
+        self.processes = []
+        for _ in range(n_workers):
+            process = context.Process(target=_rollout_worker, daemon=True,
+                args=(env_fn, agent.in_graph_norm, actor_shapes, slot_specs, weights_spec,
+                      self.weights_lock, self.weights_version, self.epsilon,
+                      self.free_slots, self.filled_slots, self.stop_event))
+            process.start()
+            self.processes.append(process)
+
+    def publish(self, epsilon=None):
+        """
+        Publish the current actor weights and normalizer statistics
+        of the agent to the rollout processes
+
+        Parameters
+        ----------
+        epsilon: new random factor for epsilon-greedy exploration
+        """
+        state_offset, state_scale = self.agent.state_norm.affine()
+        goal_offset, goal_scale = self.agent.goal_norm.affine()
+        flat = np.concatenate([w.ravel() for w in self.agent.actor.get_weights()] +
+                              [state_offset, state_scale, goal_offset, goal_scale,
+                               [self.agent.state_norm.clip_range]])
+        with self.weights_lock:
+            self.weights[:] = flat
+            self.weights_version.value += 1
+        if epsilon is not None:
+            self.epsilon.value = epsilon
+
+    def collect(self, min_episodes=1, timeout=None):
+        """
+        Collect the finished episodes
+
+        Parameters
+        ----------
+        min_episodes: minimum number of episodes to wait for
+        timeout: maximum waiting time for each of them (None: no limit)
+
+        Returns
+        -------
+        episodes: list of Episode, copied out of the shared slots
+        """
+        episodes = []
+        while True:
+            try:
+                if len(episodes) < min_episodes:
+                    slot = self.filled_slots.get(timeout=timeout)
+                else:
+                    slot = self.filled_slots.get_nowait()
+            except queue.Empty:
+                break
+            length = self.slots['length'][slot]
+            episodes.append(Episode(self.slots['obs'][slot, :length+1].copy(),
+                                    self.slots['achieved_goal'][slot, :length+1].copy(),
+                                    self.slots['desired_goal'][slot, :length].copy(),
+                                    self.slots['action'][slot, :length].copy(),
+                                    self.slots['reward'][slot, :length].copy(),
+                                    self.slots['done'][slot, :length].copy()))
+            self.free_slots.put(slot)
+        return episodes
+
+    def close(self):
+        """
+        Stop the rollout processes and release the shared memory
+        """
+        self.stop_event.set()
+        for process in self.processes:
+            process.join(JOIN_TIMEOUT)
+            if process.is_alive():
+                process.terminate()
+        for shm in self.shms:
+            shm.close()
+            shm.unlink()
+
+    def _create(self, shape, dtype):
+        """
+        Create a shared memory block viewed as a zeroed array
+        """
+        nbytes = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+        shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        self.shms.append(shm)
+        array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        array[:] = 0
+        return shm, array
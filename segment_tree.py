@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+
+"""
+Array-based segment trees for prioritized experience replay.
+The tree over n leaves is a flat array of 2*capacity nodes (capacity is the
+next power of two >= n): node i has children 2i and 2i+1, the root is
+node 1 and leaf j is node capacity+j. Updates and queries take batches of
+indexes and walk the levels with array operations, O(batch*log n)
+"""
+
+
+class SegmentTree:
+    """
+    Segment tree for an associative reduction (np.add, np.minimum)
+    """
+
+    def __init__(self, size, operation, neutral_element):
+        """
+        Parameters
+        ----------
+        size: number of leaves
+        operation: binary numpy ufunc used to reduce the children
+        neutral_element: value of the empty leaves
+        """
+        self.size = size
+        self.capacity = 1 << max(int(size - 1).bit_length(), 0)
+        self.operation = operation
+        self.neutral_element = neutral_element
+        self.tree = np.full(2 * self.capacity, neutral_element, np.float64)
+
+    def __getitem__(self, indexes):
+        return self.tree[self.capacity + np.asarray(indexes)]
+
+    def __setitem__(self, indexes, values):
+        """
+        Set the leaves at indexes and update their ancestors
+        (with repeated indexes the last value is kept)
+        """
+        nodes = self.capacity + np.asarray(indexes, dtype=np.int64).ravel()
+        self.tree[nodes] = values
+        # all the nodes are on the same level: repeated parents are
+        # written more than once, but always with the same value
+        for _ in range(self.capacity.bit_length() - 1):
+            nodes //= 2
+            self.tree[nodes] = self.operation(self.tree[2 * nodes], self.tree[2 * nodes + 1])
+
+    def reduce(self):
+        """
+        Reduction of all the leaves
+        """
+        return self.tree[1]
+
+
+class SumSegmentTree(SegmentTree):
+
+    def __init__(self, size):
+        super(SumSegmentTree, self).__init__(size, np.add, 0.0)
+
+    def sum(self):
+        return self.reduce()
+
+    def find_prefixsum_idx(self, prefixsums):
+        """
+        For each prefix sum s find the highest index i such that
+        sum(leaves[:i]) <= s, descending the tree for all of them at once
+
+        Returns
+        -------
+        leaf indexes, shape of prefixsums
+        """
+        prefixsums = np.array(prefixsums, dtype=np.float64)
+        nodes = np.ones(prefixsums.shape, np.int64)
+        while nodes[0] < self.capacity:
+            left = 2 * nodes
+            left_sums = self.tree[left]
+            go_right = prefixsums >= left_sums
+            prefixsums -= left_sums * go_right
+            nodes = left + go_right
+        # rounding errors could lead past the last non-empty leaf
+        return np.minimum(nodes - self.capacity, self.size - 1)
+
+
+class MinSegmentTree(SegmentTree):
+
+    def __init__(self, size):
+        super(MinSegmentTree, self).__init__(size, np.minimum, np.inf)
+
+    def min(self):
+        return self.reduce()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import numpy as np
+from collections import namedtuple
+
+
+"""
+Binary snapshots of the replay buffers: one .npy file per column (the
+whole preallocated column, first axis = buffer slot) and a small json
+header with the buffer counters. A snapshot is collected in two phases:
+collect_snapshot copies the slots written since the last snapshot (cheap,
+in the training thread), write_snapshot writes them in place in the column
+files (slow, can run in a background thread)
+"""
+
+
+HEADER = "header.json"
+
+
+"""
+Structure of a collected snapshot: the header, the slots to write, the
+copied rows of each column for those slots and the full column shapes
+"""
+Snapshot = namedtuple("Snapshot", field_names = \
+    ['directory', 'header', 'locations', 'rows', 'shapes'])
+
+
+def has_snapshot(directory):
+    """
+    True if directory holds a complete snapshot
+    """
+    return directory is not None and os.path.exists(os.path.join(directory, HEADER))
+
+
+def collect_snapshot(directory, header, columns, cursor, n_slots, capacity):
+    """
+    Copy the n_slots slots written before cursor (ring buffer order)
+
+    Parameters
+    ----------
+    directory: directory of the snapshot
+    header: json-serializable dict of the buffer counters
+    columns: dict {name: column array}, None if not allocated yet
+    cursor: next slot to be written
+    n_slots: number of slots to copy
+    capacity: number of slots of the columns
+
+    Return
+    ------
+    Snapshot to be written with write_snapshot
+    """
+    locations = (cursor - n_slots + np.arange(n_slots)) % capacity
+    if columns is None:
+        return Snapshot(directory, header, locations, {}, {})
+    rows = {name: column[locations] for name, column in columns.items()}
+    shapes = {name: column.shape for name, column in columns.items()}
+    return Snapshot(directory, header, locations, rows, shapes)
+
+
+def write_snapshot(snapshot):
+    """
+    Write the rows of a collected snapshot in the column files (created
+    if missing), then replace the header
+    """
+    os.makedirs(snapshot.directory, exist_ok=True)
+    for name, rows in snapshot.rows.items():
+        path = os.path.join(snapshot.directory, name + ".npy")
+        if os.path.exists(path):
+            column = np.lib.format.open_memmap(path, mode="r+")
+            # raw bytes of an extension dtype (see read_column)
+            if column.dtype.kind == 'V':
+                column = column.view(rows.dtype)
+        else:
+            column = np.lib.format.open_memmap(path, mode="w+", dtype=rows.dtype,
+                                               shape=snapshot.shapes[name])
+        column[snapshot.locations] = rows
+        column.flush()
+        del column
+    header_path = os.path.join(snapshot.directory, HEADER)
+    with open(header_path + ".tmp", "w") as header_file:
+        json.dump(snapshot.header, header_file)
+    os.replace(header_path + ".tmp", header_path)
+
+
+def read_header(directory):
+    with open(os.path.join(directory, HEADER)) as header_file:
+        return json.load(header_file)
+
+
+def read_column(directory, name, dtype=None):
+    """
+    Map a column file of a snapshot (read-only). The .npy format has no 
+    descriptor for extension dtypes (bfloat16), whose columns are read 
+    back as raw bytes: they are viewed as dtype if given
+    """
+    column = np.load(os.path.join(directory, name + ".npy"), mmap_mode="r")
+    if dtype is not None and column.dtype.kind == 'V':
+        column = column.view(dtype)
+    return column
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+import os
+import numpy as np
+
+from goal_env import PointGoalEnv
+from HER import HER_Buffer
+from HER_SAC_agent import HER_SAC_Agent
+from checkpoint import TrainingCheckpointer
+
+
+SIZE = 4000
+N_ITEMS = 1000
+
+
+def two_checkpoints(directory, filled_buffer):
+    """
+    Checkpoints 0 and 1 of an agent whose buffer grows between them
+
+    Returns
+    -------
+    the rows of the buffer at checkpoint 0
+    """
+    her_buffer = filled_buffer(SIZE, n_items=N_ITEMS)
+    agent = HER_SAC_Agent(PointGoalEnv(), her_buffer, compiled=False)
+    checkpointer = TrainingCheckpointer(agent, directory)
+    states = her_buffer.states[:N_ITEMS].copy()
+    checkpointer.save({'cycle': 0})
+    her_buffer.store_batch(her_buffer.sample(minibatch_size=N_ITEMS))
+    checkpointer.save({'cycle': 1})
+    checkpointer.close()
+    return states
+
+
+def restored_agent(directory, number=None):
+    agent = HER_SAC_Agent(PointGoalEnv(), HER_Buffer(SIZE), compiled=False)
+    checkpointer = TrainingCheckpointer(agent, directory)
+    counters = checkpointer.restore(number)
+    checkpointer.close()
+    return agent, counters
+
+
+def assert_buffer_of_first_checkpoint(agent, counters, states):
+    assert counters == {'cycle': 0}
+    assert agent.her_buffer.cursor == agent.her_buffer.size == N_ITEMS
+    np.testing.assert_array_equal(agent.her_buffer.states[:N_ITEMS], states)
+
+
+def test_older_checkpoint_restores_its_buffer(tmp_path, filled_buffer):
+    states = two_checkpoints(str(tmp_path), filled_buffer)
+    agent, counters = restored_agent(str(tmp_path), number=0)
+    assert_buffer_of_first_checkpoint(agent, counters, states)
+
+
+def test_unpublished_checkpoint_is_ignored(tmp_path, filled_buffer):
+    # crash after the buffer snapshot of checkpoint 1, before its state file
+    states = two_checkpoints(str(tmp_path), filled_buffer)
+    os.remove(os.path.join(str(tmp_path), "state-1.json"))
+    agent, counters = restored_agent(str(tmp_path))
+    assert_buffer_of_first_checkpoint(agent, counters, states)
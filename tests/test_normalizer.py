@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import pytest
+
+from normalizer import Normalizer
+
+
+N_SAMPLES = 10**7
+CHUNK = 10**6
+SIZE = 3
+
+
+@pytest.fixture(scope="module")
+def samples():
+    """
+    10^7 float32 samples with a large offset and small spread, the case
+    where sum/sum-of-squares accumulators lose precision
+    """
+    rng = np.random.default_rng(0)
+    offset = np.array([1e3, -50., 0.], np.float32)
+    scale = np.array([1e-2, 3., 1.], np.float32)
+    return (offset + scale * rng.standard_normal((N_SAMPLES, SIZE), np.float32)).astype(np.float32)
+
+
+def fed_normalizer(chunks):
+    normalizer = Normalizer(SIZE, eps=1e-6)
+    for chunk in chunks:
+        normalizer.update(chunk)
+    return normalizer
+
+
+def test_moments_match_numpy(samples):
+    normalizer = fed_normalizer(np.split(samples, N_SAMPLES // CHUNK))
+    mean = np.mean(samples, axis=0, dtype=np.float64)
+    std = np.std(samples, axis=0, dtype=np.float64)
+    assert normalizer.local_count == N_SAMPLES
+    np.testing.assert_allclose(normalizer.local_mean, mean, rtol=1e-12, atol=1e-12)
+    np.testing.assert_allclose(np.sqrt(normalizer.local_m2 / N_SAMPLES), std, rtol=1e-9)
+    # float32 statistics used by the networks
+    np.testing.assert_allclose(normalizer.mean, mean, rtol=1e-6)
+    np.testing.assert_allclose(normalizer.std, std, rtol=1e-6)
+
+
+def test_merge_matches_single_normalizer(samples):
+    chunks = np.split(samples, N_SAMPLES // CHUNK)
+    single = fed_normalizer(chunks)
+    # uneven partial normalizers, merged in order
+    merged = fed_normalizer(chunks[:1])
+    for part in (chunks[1:4], chunks[4:9], chunks[9:]):
+        merged.merge(fed_normalizer(part))
+    assert merged.local_count == single.local_count
+    np.testing.assert_allclose(merged.local_mean, single.local_mean, rtol=1e-12, atol=1e-12)
+    np.testing.assert_allclose(merged.local_m2, single.local_m2, rtol=1e-9)
+    np.testing.assert_allclose(merged.std, single.std, rtol=1e-6)
+
+
+def test_empty_update_is_ignored():
+    normalizer = fed_normalizer([np.ones((10, SIZE)), np.empty((0, SIZE))])
+    assert normalizer.local_count == 10
+    np.testing.assert_array_equal(normalizer.mean, np.ones(SIZE, np.float32))
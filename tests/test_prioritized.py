@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+
+SIZE = 20000
+MINIBATCH = 256
+N_STEPS = 50
+
+
+def assert_rows_span_buffer(indexes):
+    """
+    Each minibatch (row) has items from the first and the last tenth of
+    the buffer, and from all its deciles
+    """
+    for row in indexes.reshape(N_STEPS, MINIBATCH):
+        assert row.min() < SIZE // 10 and row.max() >= SIZE - SIZE // 10
+        assert len(np.unique(row * 10 // SIZE)) == 10
+
+
+def test_block_minibatches_are_stratified_independently(filled_buffer):
+    her_buffer = filled_buffer(SIZE, prioritized=True)
+    _, weights, indexes = her_buffer.sample_prioritized(MINIBATCH, n_batches=N_STEPS)
+    assert indexes.shape == weights.shape == (N_STEPS * MINIBATCH,)
+    assert_rows_span_buffer(indexes)
+
+
+def test_block_minibatches_follow_priorities(filled_buffer):
+    her_buffer = filled_buffer(SIZE, prioritized=True)
+    # the second half ten times more likely than the first one
+    her_buffer.update_priorities(np.arange(SIZE // 2, SIZE), np.full(SIZE // 2, 10.0 ** (1 / 0.6)))
+    _, _, indexes = her_buffer.sample_prioritized(MINIBATCH, n_batches=N_STEPS)
+    for row in indexes.reshape(N_STEPS, MINIBATCH):
+        assert abs(np.mean(row >= SIZE // 2) - 10 / 11) < 0.05
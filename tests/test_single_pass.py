@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from goal_env import PointGoalEnv
+from HER_SAC_agent import HER_SAC_Agent
+
+
+SIZE = 5000
+N_STEPS = 200
+# max difference of the mean actor/temperature losses, in standard
+# errors of the difference (the two updates sample different actions)
+TOLERANCE_SE = 4
+
+
+@pytest.fixture
+def agents(filled_buffer):
+    """
+    Sequential and single-pass agents (eager) with the same weights and
+    normalizers, and a preprocessed minibatch
+    """
+    her_buffer = filled_buffer(SIZE)
+    normalizer_batch = [her_buffer.sample(minibatch_size=1000)]
+    sequential, single_pass = [HER_SAC_Agent(PointGoalEnv(), her_buffer, compiled=False,
+                                             single_pass=mode) for mode in (False, True)]
+    for agent in (sequential, single_pass):
+        agent.update_normalizer(normalizer_batch, hindsight=True)
+    for network in ("actor", "value", "target_value"):
+        getattr(single_pass, network).set_weights(getattr(sequential, network).get_weights())
+    for critic, reference in zip(single_pass.critic_networks, sequential.critic_networks):
+        critic.set_weights(reference.get_weights())
+    minibatch, weights, _ = sequential.sample_minibatch()
+    return sequential, single_pass, sequential.train_inputs(minibatch, weights)
+
+
+def test_losses_and_td_errors_match_sequential(agents):
+    # value and critic losses and TD errors come before any update in both
+    sequential, single_pass, inputs = agents
+    outputs = []
+    for agent in (sequential, single_pass):
+        tf.random.set_seed(0)
+        value_loss, critic_losses, _, _, td_errors = agent.train_step(*inputs)
+        outputs.append([value_loss.numpy(), critic_losses.numpy(), td_errors.numpy()])
+    for sequential_output, single_pass_output in zip(*outputs):
+        np.testing.assert_array_equal(single_pass_output, sequential_output)
+
+
+def test_expected_actor_and_temperature_losses_match_sequential(agents):
+    # at zero learning rates the weights are fixed: the mean losses over
+    # N_STEPS steps estimate the same expectations
+    sequential, single_pass, inputs = agents
+    losses = []
+    for agent in (sequential, single_pass):
+        for optimizer in (agent.actor_optimizer, *agent.critic_optimizers,
+                          agent.value_optimizer, agent.temperature_optimizer):
+            optimizer.learning_rate.assign(0.0)
+        tf.random.set_seed(0)
+        steps = [agent.train_step(*inputs) for _ in range(N_STEPS)]
+        losses.append(np.array([[step[2].numpy(), step[3].numpy()] for step in steps]))
+    sequential_losses, single_pass_losses = losses
+    difference = np.mean(single_pass_losses, axis=0) - np.mean(sequential_losses, axis=0)
+    standard_error = np.sqrt((np.var(single_pass_losses, axis=0) +
+                              np.var(sequential_losses, axis=0)) / N_STEPS)
+    assert np.all(np.abs(difference) <= TOLERANCE_SE * standard_error)
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import pytest
+
+from goal_env import OBS_SIZE, GOAL_SIZE, ACTION_SIZE
+from HER import HER_Buffer, HER_Episode_Buffer, Episode
+
+
+SIZE = 1000
+EPISODE_LEN = 50
+
+
+def snapshot_twice(her_buffer, store, directory):
+    """
+    Full snapshot, new items, incremental snapshot
+    """
+    store()
+    her_buffer.snapshot(directory)
+    store()
+    her_buffer.snapshot(directory)
+
+
+@pytest.mark.parametrize("state_dtype", ["float16", "bfloat16"])
+def test_incremental_snapshot_of_half_precision_buffer(tmp_path, filled_buffer, state_dtype):
+    her_buffer = HER_Buffer(SIZE, state_dtype=state_dtype)
+    batch = filled_buffer(SIZE // 4).sample(minibatch_size=SIZE // 4)
+    snapshot_twice(her_buffer, lambda: her_buffer.store_batch(batch), str(tmp_path))
+    restored = HER_Buffer(SIZE, state_dtype=state_dtype)
+    restored.restore(str(tmp_path))
+    assert restored.size == her_buffer.size == SIZE // 2
+    assert restored.states.dtype == her_buffer.states.dtype
+    np.testing.assert_array_equal(restored.states.astype(np.float32), 
+                                  her_buffer.states.astype(np.float32))
+
+
+@pytest.mark.parametrize("state_dtype", ["float16", "bfloat16"])
+def test_incremental_snapshot_of_half_precision_episode_buffer(tmp_path, state_dtype):
+    rng = np.random.default_rng(0)
+
+    def episode():
+        return Episode(rng.standard_normal((EPISODE_LEN + 1, OBS_SIZE)),
+                       rng.standard_normal((EPISODE_LEN + 1, GOAL_SIZE)),
+                       np.repeat(rng.standard_normal((1, GOAL_SIZE)), EPISODE_LEN, axis=0),
+                       rng.uniform(-1, 1, (EPISODE_LEN, ACTION_SIZE)), 
+                       np.zeros(EPISODE_LEN), np.zeros(EPISODE_LEN))
+
+    def reward_fn(achieved_goal, desired_goal, info):
+        return -np.ones(len(achieved_goal), np.float32)
+
+    her_buffer = HER_Episode_Buffer(SIZE, EPISODE_LEN, reward_fn, state_dtype=state_dtype)
+    snapshot_twice(her_buffer, lambda: her_buffer.store_episode(episode()), str(tmp_path))
+    restored = HER_Episode_Buffer(SIZE, EPISODE_LEN, reward_fn, state_dtype=state_dtype)
+    restored.restore(str(tmp_path))
+    assert restored.n_episodes == her_buffer.n_episodes == 2
+    np.testing.assert_array_equal(restored.obs.astype(np.float32), 
+                                  her_buffer.obs.astype(np.float32))
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import multiprocessing as mp
+
+
+"""
+Vectorised GoalEnvs: N environments stepped in lockstep, with the dict
+observations stacked along the first axis ({key: [N, dim]})
+"""
+
+
+def stack_observations(observations):
+    """
+    Stack a list of dict observations into a dict of arrays
+    """
+    return {key: np.stack([obs[key] for obs in observations])
+            for key in observations[0]}
+
+
+class VecGoalEnv:
+    """
+    In-process vectorised env: a list of envs stepped one after the other
+    """
+
+    def __init__(self, env_fns):
+        self.envs = [env_fn() for env_fn in env_fns]
+        self.num_envs = len(self.envs)
+        self.observations = [None] * self.num_envs
+
+    def reset(self):
+        """
+        Reset all the envs
+
+        Returns
+        -------
+        observations stacked as {key: [N, dim]}
+        """
+        self.observations = [env.reset() for env in self.envs]
+        return stack_observations(self.observations)
+
+    def step(self, actions, active=None):
+        """
+        Step the envs in lockstep
+
+        Parameters
+        ----------
+        actions: actions for all the envs, shape [N, action_size]
+        active: boolean mask of the envs to step (the others are left
+            untouched and return their last observation)
+
+        Returns
+        -------
+        stacked observations, rewards [N], dones [N] and the list of infos
+        """
+        if active is None:
+            active = np.ones(self.num_envs, dtype=bool)
+        rewards = np.zeros(self.num_envs, np.float32)
+        dones = np.ones(self.num_envs, dtype=bool)
+        infos = [{} for _ in range(self.num_envs)]
+        for i in np.flatnonzero(active):
+            self.observations[i], rewards[i], dones[i], infos[i] = \
+                self.envs[i].step(actions[i])
+        return stack_observations(self.observations), rewards, dones, infos
+
+    def close(self):
+        for env in self.envs:
+            env.close()
+
+
+def _subproc_worker(remote, parent_remote, env_fn):
+    """
+    Loop of a worker process owning one env
+    """
+    parent_remote.close()
+    env = env_fn()
+    try:
+        while True:
+            command, data = remote.recv()
+            if command == "step":
+                remote.send(env.step(data))
+            elif command == "reset":
+                remote.send(env.reset())
+            elif command == "close":
+                break
+            else:
+                raise TypeError("Wrong command for the env worker")
+    finally:
+        env.close()
+        remote.close()
+
+
+class SubprocVecGoalEnv:
+    """
+    Vectorised env with one worker process per env, connected with pipes
+    """
+
+    def __init__(self, env_fns, start_method="spawn"):
+        context = mp.get_context(start_method)
+        self.num_envs = len(env_fns)
+        self.remotes, work_remotes = zip(*[context.Pipe() for _ in range(self.num_envs)])
+        self.processes = []
+        for remote, work_remote, env_fn in zip(self.remotes, work_remotes, env_fns):
+            process = context.Process(target=_subproc_worker,
+                                      args=(work_remote, remote, env_fn), daemon=True)
+            process.start()
+            work_remote.close()
+            self.processes.append(process)
+        self.observations = [None] * self.num_envs
+
+    def reset(self):
+        """
+        Reset all the envs (see VecGoalEnv.reset)
+        """
+        for remote in self.remotes:
+            remote.send(("reset", None))
+        self.observations = [remote.recv() for remote in self.remotes]
+        return stack_observations(self.observations)
+
+    def step(self, actions, active=None):
+        """
+        Step the envs in lockstep, in parallel (see VecGoalEnv.step)
+        """
+        if active is None:
+            active = np.ones(self.num_envs, dtype=bool)
+        indexes = np.flatnonzero(active)
+        for i in indexes:
+            self.remotes[i].send(("step", actions[i]))
+        rewards = np.zeros(self.num_envs, np.float32)
+        dones = np.ones(self.num_envs, dtype=bool)
+        infos = [{} for _ in range(self.num_envs)]
+        for i in indexes:
+            self.observations[i], rewards[i], dones[i], infos[i] = self.remotes[i].recv()
+        return stack_observations(self.observations), rewards, dones, infos
+
+    def close(self):
+        for remote in self.remotes:
+            remote.send(("close", None))
+        for process in self.processes:
+            process.join()